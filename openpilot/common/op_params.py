@@ -1,70 +1,549 @@
 #!/usr/bin/env python3
 import os
+import sys
+import stat
 import json
-from common.colors import COLORS
+import time
+import zlib
+import struct
+import fcntl
+import threading
+from contextlib import contextmanager, nullcontext
 from common.travis_checker import BASEDIR
-from atomicwrites import atomic_write
+from common.op_params_scheduler import RefreshScheduler
+from common.op_params_codec import ARRAY_DTYPES, CODECS, encode_value, decode_value
 try:
   from common.realtime import sec_since_boot
 except ImportError:
-  import time
   sec_since_boot = time.time
 
-warning = lambda msg: print('{}opParams WARNING: {}{}'.format(COLORS.WARNING, msg, COLORS.ENDC))
-error = lambda msg: print('{}opParams ERROR: {}{}'.format(COLORS.FAIL, msg, COLORS.ENDC))
+# colors, atomicwrites and the optional backends are imported where they're used so importing opParams stays cheap
+
+
+def warning(msg):
+  from common.colors import COLORS
+  print('{}opParams WARNING: {}{}'.format(COLORS.WARNING, msg, COLORS.ENDC))
+
+
+def error(msg):
+  from common.colors import COLORS
+  print('{}opParams ERROR: {}{}'.format(COLORS.FAIL, msg, COLORS.ENDC))
+
 
 NUMBER = [float, int]  # value types
 NONE_OR_NUMBER = [type(None), float, int]
 
 BASEDIR = os.path.dirname(BASEDIR)
-PARAMS_DIR = os.path.join(BASEDIR, 'community', 'params')
+PARAMS_DIR = os.path.join(BASEDIR, 'community', 'params')  # a symlink to the active profile once profiles are used
+PROFILES_DIR = os.path.join(BASEDIR, 'community', 'profiles')
+JOURNAL_PATH = os.path.join(BASEDIR, 'community', 'params.journal')  # one history across profile switches
 IMPORTED_PATH = os.path.join(PARAMS_DIR, '.imported')
 OLD_PARAMS_FILE = os.path.join(BASEDIR, 'op_params.json')
+PACKED_PATH = os.path.join(PARAMS_DIR, '.packed')
+LOCK_PATH = os.path.join(PARAMS_DIR, '.lock')
+SHM_LOCK_PATH = os.path.join(BASEDIR, 'community', '.params_shm_lock')  # one segment for all profiles
+SHM_PATH = '/dev/shm/op_params'  # the segment (op_params_shm.SHM_NAME): once it exists, every writer publishes to it
+INIT_MARKER_PATH = os.path.join(PARAMS_DIR, '.initialized')
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+RACY_NS = 2 * 10 ** 9  # see _settled, covers filesystems with 1-2 second timestamps
 
 
 class Param:
-  def __init__(self, default, allowed_types=[], description=None, *, static=False, live=False, hidden=False):
+  """
+    A param's definition. Immutable once created, so one schema (FORK_PARAMS) is built per process and shared by
+    every opParams instance, which keep their own values and read times.
+  """
+  __slots__ = ('default_value', 'allowed_types', 'description', 'hidden', 'live', 'static', 'read_frequency', 'min_val', 'max_val',
+               'choices', 'length', 'predicate', 'clamp', 'has_allowed_types', 'has_description', 'is_list', 'is_array', '_validate', '_frozen')
+
+  def __init__(self, default, allowed_types=(), description=None, *, static=False, live=False, hidden=False,
+               read_frequency=None, min_val=None, max_val=None, choices=None, length=None, predicate=None, clamp=True):
     self.default_value = default  # value first saved and returned if actual value isn't a valid type
-    if not isinstance(allowed_types, list):
+    if not isinstance(allowed_types, (list, tuple, set, frozenset)):
       allowed_types = [allowed_types]
-    self.allowed_types = allowed_types  # allowed python value types for opEdit
+    self.allowed_types = frozenset(allowed_types)  # allowed python value types for opEdit, the element types for lists
     self.description = description  # description to be shown in opEdit
     self.hidden = hidden  # hide this param to user in opEdit
     self.live = live  # show under the live menu in opEdit
     self.static = static  # use cached value, never reads to update
+    self.read_frequency = read_frequency  # how often to read param file (sec), defaults to 1 if live else 10
+    self.min_val = min_val  # numbers (or every number in a list) must be within min_val and max_val
+    self.max_val = max_val
+    self.choices = choices  # value must be one of these
+    self.length = length  # lists must be this long
+    self.predicate = predicate  # custom check: a function taking the value, returning True if it's valid
+    self.clamp = clamp  # out of range values loaded from disk are clamped, otherwise the default is used
     self._create_attrs()
+    self._frozen = True
+
+  def __setattr__(self, name, value):
+    if getattr(self, '_frozen', False):
+      raise AttributeError('opParams: Params can\'t be changed once created, tried to set {}'.format(name))
+    object.__setattr__(self, name, value)
 
   def is_valid(self, value):
+    return self.check(value) is None
+
+  def default_copy(self):  # the default to hand out: the schema is shared, so a list from .get() mustn't be its list
+    return list(self.default_value) if type(self.default_value) is list else self.default_value
+
+  def check(self, value):  # Returns None if value can be put, otherwise the reason it can't
+    if not self._is_valid_type(value):
+      if self.is_list and type(value) is list:
+        value = next(v for v in value if type(v) not in self.allowed_types)  # report the element that's wrong
+      return 'The type of data you entered ({}) is not allowed with this parameter!'.format(type(value).__name__)
+    try:
+      self._validate(value, True)
+    except ValueError as e:
+      return str(e)
+    return None
+
+  def normalize(self, value, previous=None):  # converts a value as loaded or put into the form .get() returns
+    if value is previous:
+      return value
+    if not self._is_valid_type(value):
+      warning('User\'s value type ({}) is not valid! Using default'.format(type(value).__name__))
+      return self.default_copy()
+    try:
+      return self._validate(value, False)  # clamps instead of failing if clamp is set
+    except ValueError as e:
+      warning('User\'s value is not valid: {} Using default'.format(e))
+      return self.default_copy()
+
+  def _usable(self, value):  # False if normalize would fall back to the default
+    if not self._is_valid_type(value):
+      return False
+    try:
+      self._validate(value, False)
+    except ValueError:
+      return False
+    return True
+
+  def describe_constraints(self):  # for opEdit
+    constraints = []
+    if self.min_val is not None or self.max_val is not None:
+      constraints.append('{}range: {} to {}'.format('element ' if self.is_list else '', self.min_val, self.max_val))
+    if self.choices is not None:
+      constraints.append('one of: {}'.format(', '.join(map(str, self.choices))))
+    if self.length is not None:
+      constraints.append('length: {}'.format(self.length))
+    return constraints
+
+  def _is_valid_type(self, value):
     if not self.has_allowed_types:  # always valid if no allowed types, otherwise checks to make sure
       return True
+    if self.is_list and type(value) is list:  # the remaining allowed_types apply to the elements, none left means any
+      return not self.allowed_types or all(type(v) in self.allowed_types for v in value)
     return type(value) in self.allowed_types
 
+  def _compile_validator(self):
+    """
+      Compiles the constraints into a single function, once per Param, that's run only when a value changes.
+      validate(value, strict) returns the value, clamped to range unless strict, or raises ValueError.
+    """
+    steps = []
+    if self.min_val is not None or self.max_val is not None:
+      lo = -float('inf') if self.min_val is None else self.min_val
+      hi = float('inf') if self.max_val is None else self.max_val
+      clamp = self.clamp
+
+      def clamp_number(v, strict):
+        if isinstance(v, bool) or not isinstance(v, (int, float)) or lo <= v <= hi:  # None, strings, etc. pass through
+          return v
+        if strict or not clamp or v != v:  # never clamp NaN
+          raise ValueError('Value must be between {} and {}!'.format(self.min_val, self.max_val))
+        return min(max(v, lo), hi)
+
+      steps.append((lambda v, strict: [clamp_number(e, strict) for e in v] if type(v) is list else clamp_number(v, strict)) if self.is_list else clamp_number)
+
+    if self.choices is not None:
+      choices = self.choices
+
+      def check_choice(v, strict):
+        if v not in choices:
+          raise ValueError('Value must be one of: {}!'.format(', '.join(map(str, choices))))
+        return v
+      steps.append(check_choice)
+
+    if self.length is not None:
+      length = self.length
+
+      def check_length(v, strict):
+        if type(v) is list and len(v) != length:
+          raise ValueError('List must have {} elements!'.format(length))
+        return v
+      steps.append(check_length)
+
+    if self.predicate is not None:
+      predicate = self.predicate
+
+      def check_predicate(v, strict):
+        if not _accepts(predicate, v):
+          raise ValueError('Value was rejected by this parameter\'s check!')
+        return v
+      steps.append(check_predicate)
+
+    if not steps:
+      return lambda v, strict: v
+    if len(steps) == 1:
+      return steps[0]
+
+    def validate(v, strict):
+      for step in steps:
+        v = step(v, strict)
+      return v
+    return validate
+
   def _create_attrs(self):  # Create attributes and check Param is valid
-    self.has_allowed_types = isinstance(self.allowed_types, list) and len(self.allowed_types) > 0
+    self.has_allowed_types = len(self.allowed_types) > 0
     self.has_description = self.description is not None
     self.is_list = list in self.allowed_types
-    self.read_frequency = None if self.static else (1 if self.live else 10)  # how often to read param file (sec)
-    self.last_read = -1
+    self.is_array = False
+    if self.static:
+      self.read_frequency = None
+    elif self.read_frequency is None:
+      self.read_frequency = 1 if self.live else 10
     if self.has_allowed_types:
       assert type(self.default_value) in self.allowed_types, 'Default value type must be in specified allowed_types!'
     if self.is_list:
-      self.allowed_types.remove(list)
+      self.allowed_types = self.allowed_types - {list}
+    self._validate = self._compile_validator()
+    assert self.check(self.default_value) is None, 'Default value must satisfy the constraints of the Param!'
 
 
-def _read_param(key):  # Returns None, False if a json error occurs
+def _accepts(predicate, value):  # a predicate that fails on a value (an IndexError on a short list, say) rejects it
   try:
-    with open(os.path.join(PARAMS_DIR, key), 'r') as f:
-      value = json.loads(f.read())
+    return bool(predicate(value))
+  except Exception:
+    return False
+
+
+def _numpy():  # numpy is only imported by processes that use array params
+  import numpy
+  return numpy
+
+
+class ArrayParam(Param):
+  """
+    A numeric array param, stored as compact binary (float32 or float64) instead of a json list.
+    .get() returns a read-only numpy array, and the same array object for as long as the stored values don't change.
+    Shape and range are checked in one vectorized pass when a new value is loaded or put, not on every .get().
+      Param(...) args plus:
+        shape: required shape, use None for any length along an axis, e.g. (None,) for any 1D array
+        min_val, max_val: every element must be within this range (NaN is never valid)
+        dtype: 'float64' (default) or 'float32'
+  """
+  __slots__ = ('dtype', 'shape')
+
+  def __init__(self, default, description=None, *, shape=None, min_val=None, max_val=None, dtype='float64',
+               predicate=None, clamp=True, static=False, live=False, hidden=False, read_frequency=None):
+    assert dtype in ARRAY_DTYPES, 'dtype must be one of {}'.format(', '.join(ARRAY_DTYPES))
+    self.dtype = dtype
+    self.shape = shape
+    super().__init__(default, [], description, static=static, live=live, hidden=hidden, read_frequency=read_frequency,
+                     min_val=min_val, max_val=max_val, predicate=predicate, clamp=clamp)
+
+  def _is_valid_type(self, value):
+    return True  # anything numpy can convert, checked with the shape in _validate
+
+  def describe_constraints(self):
+    constraints = super().describe_constraints()
+    if self.shape is not None:
+      constraints.append('shape: ({})'.format(', '.join('any' if s is None else str(s) for s in self.shape)))
+    return constraints
+
+  def _compile_validator(self):
+    lo = -float('inf') if self.min_val is None else self.min_val
+    hi = float('inf') if self.max_val is None else self.max_val
+    shape, dtype, clamp, predicate = self.shape, self.dtype, self.clamp, self.predicate
+
+    def validate(value, strict):
+      np = _numpy()
+      try:
+        arr = np.asarray(value, dtype=dtype)
+      except (TypeError, ValueError):
+        raise ValueError('Value must be a list of numbers!')
+      if shape is not None and (arr.ndim != len(shape) or any(s is not None and s != n for s, n in zip(shape, arr.shape))):
+        raise ValueError('Value must have shape ({})!'.format(', '.join('any' if s is None else str(s) for s in shape)))
+      selected = self._range_checked(arr)
+      if not np.all((selected >= lo) & (selected <= hi)):  # one vectorized check, false for NaN too
+        if strict or not clamp or np.isnan(selected).any():
+          raise ValueError('Values must be between {} and {}!'.format(self.min_val, self.max_val))
+        arr = np.array(arr)
+        self._range_checked(arr)[...] = np.clip(selected, lo, hi)
+      if not self._check_structure(np, arr):
+        raise ValueError(self._structure_error)
+      if predicate is not None and not _accepts(predicate, arr):
+        raise ValueError('Value was rejected by this parameter\'s check!')
+      return arr
+    return validate
+
+  def _range_checked(self, arr):  # the part of the array min_val/max_val apply to
+    return arr
+
+  _structure_error = ''
+
+  def _check_structure(self, np, arr):
+    return True
+
+  def normalize(self, value, previous=None):
+    np = _numpy()
+    if value is previous:
+      return value
+    arr = super().normalize(value)
+    if arr is self.default_value:
+      return arr
+    if arr.dtype != self.dtype or arr.flags.writeable:
+      arr = np.array(arr, dtype=self.dtype)
+      arr.flags.writeable = False
+    if previous is not None and isinstance(previous, np.ndarray) and previous.shape == arr.shape and np.array_equal(previous, arr):
+      return previous  # unchanged: keep handing out the same array
+    return arr
+
+  def _create_attrs(self):
+    np = _numpy()
+    self.default_value = np.array(self.default_value, dtype=self.dtype)
+    self.default_value.flags.writeable = False
+    super()._create_attrs()
+    self.is_list = True  # edited element by element in opEdit
+    self.is_array = True
+
+
+class TableParam(ArrayParam):
+  """
+    An interpolation table: a 2xN array of breakpoints and values, breakpoints strictly increasing.
+    min_val and max_val apply to the values, not the breakpoints. Use it with: np.interp(x, *op_params.get('my_table'))
+  """
+  __slots__ = ()
+
+  def __init__(self, default, description=None, *, min_val=None, max_val=None, dtype='float64',
+               predicate=None, clamp=True, static=False, live=False, hidden=False, read_frequency=None):
+    super().__init__(default, description, shape=(2, None), min_val=min_val, max_val=max_val, dtype=dtype,
+                     predicate=predicate, clamp=clamp, static=static, live=live, hidden=hidden, read_frequency=read_frequency)
+
+  def _range_checked(self, arr):
+    return arr[1]
+
+  _structure_error = 'Breakpoints must be strictly increasing!'
+
+  def _check_structure(self, np, arr):
+    return bool(np.all(np.diff(arr[0]) > 0))
+
+
+def _is_array(value):
+  return 'numpy' in sys.modules and isinstance(value, sys.modules['numpy'].ndarray)
+
+
+def _same(a, b):  # arrays are only equal by identity, Param.normalize keeps an unchanged array's object
+  return a is b or (type(a) is type(b) and not _is_array(a) and a == b)
+
+
+def _equal(a, b):  # values from different reads, so arrays are compared by value
+  if _is_array(a) or _is_array(b):
+    return _is_array(a) and _is_array(b) and a.shape == b.shape and bool((a == b).all())
+  return _same(a, b)
+
+
+def _profiles_module():  # profiles are only imported by processes that use them
+  from common import op_params_profiles as profiles
+  return profiles
+
+
+def _link_stat(path):  # changes whenever the active profile is switched, None while path isn't a symlink
+  try:
+    st = os.lstat(path)
+  except FileNotFoundError:
+    return None
+  return (st.st_ino, st.st_mtime_ns) if stat.S_ISLNK(st.st_mode) else None
+
+
+def _decode_jsonable(data):
+  value = decode_value(data)
+  return value.tolist() if _is_array(value) else value
+
+
+def _jsonable(params):  # arrays as lists, for the packed store and shared memory which hold json
+  return {k: v.tolist() if _is_array(v) else v for k, v in params.items()}
+
+
+class ParamHandle:
+  """
+    A bound accessor for one param, returned by opParams.handle(key). The key is checked once on creation and
+    values are validated when they're loaded or put, so in a hot loop .value is a plain attribute load.
+    .value only stays current on its own with watch=True, where the watcher thread updates it. Otherwise call .get():
+    the read_frequency timer and the shared snapshot (shared=True) are only checked there.
+  """
+  __slots__ = ('key', 'value', '_op_params', '_param')
+
+  def __init__(self, op_params, key):
+    self.key = key
+    self._op_params = op_params
+    self._param = op_params.fork_params[key]
+    self.value = op_params.params[key]
+
+  def get(self):
+    self._op_params._maybe_refresh(self.key, self._param)
+    return self.value
+
+  def _update(self, value):  # value was already normalized by opParams._set_value
+    self.value = value
+
+
+def _read_param(key, params_dir=None):  # Returns None, False if the file is missing or can't be decoded
+  try:
+    with open(os.path.join(params_dir or PARAMS_DIR, key), 'rb') as f:
+      data = f.read()
+    if _stats is None:
+      value = decode_value(data)  # any codec, and plain json from older versions
+    else:
+      t = time.perf_counter_ns()
+      value = decode_value(data)
+      _stats.decoded(key, time.perf_counter_ns() - t, len(data))
     return value, True
-  except json.decoder.JSONDecodeError:
+  except (FileNotFoundError, KeyError, ValueError, struct.error):  # JSONDecodeError is a ValueError
     return None, False
 
 
-def _write_param(key, value):
-  param_path = os.path.join(PARAMS_DIR, key)
-  with atomic_write(param_path, overwrite=True) as f:
-    f.write(json.dumps(value))
+def _stat_key(st):  # atomic writes replace the file, so a new inode means new content even within one mtime tick
+  return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def _settled(st):
+  """
+    Racy timestamp guard: a file modified within RACY_NS of now could be modified again without its mtime changing
+    (coarse timestamps, reused inodes), so its stat is only trusted to mean unchanged once it's older than that.
+  """
+  return time.time_ns() - st.st_mtime_ns > RACY_NS
+
+
+def _write_param(key, value, codec='json', params_dir=None):
+  from atomicwrites import atomic_write
+  t = time.perf_counter_ns()
+  param_path = os.path.join(params_dir or PARAMS_DIR, key)
+  with atomic_write(param_path, mode='wb', overwrite=True) as f:
+    f.write(encode_value(value, codec))
   os.chmod(param_path, 0o666)
+  if _stats is not None:
+    _stats.written(key, time.perf_counter_ns() - t)  # including the fsync
+
+
+def _write_params(params, codec='json', params_dir=None):  # all files are synced before any is renamed into place, then the directory once
+  params_dir = params_dir or PARAMS_DIR
+  if len(params) == 1:
+    _write_param(*next(iter(params.items())), codec, params_dir)
+    return
+
+  import tempfile
+  t = time.perf_counter_ns()
+  tmp_paths = []
+  try:
+    for key, value in params.items():
+      fd, tmp_path = tempfile.mkstemp(prefix='.' + key, dir=params_dir)  # dotfiles are ignored by readers
+      tmp_paths.append((tmp_path, key))
+      with os.fdopen(fd, 'wb') as f:
+        f.write(encode_value(value, codec))
+        f.flush()
+        os.fsync(f.fileno())  # only this file, os.sync() would also flush every other writer on the device
+      os.chmod(tmp_path, 0o666)
+    while tmp_paths:
+      tmp_path, key = tmp_paths.pop()
+      os.replace(tmp_path, os.path.join(params_dir, key))
+  finally:
+    for tmp_path, _ in tmp_paths:
+      os.remove(tmp_path)
+
+  dir_fd = os.open(params_dir, os.O_RDONLY)
+  try:
+    os.fsync(dir_fd)  # make the renames durable
+  finally:
+    os.close(dir_fd)
+  if _stats is not None:
+    for key in params:  # each key waited for the whole batch
+      _stats.written(key, time.perf_counter_ns() - t)
+
+
+_stats = None  # ParamsStats while instrumentation is enabled
+
+
+def enable_stats(dump_path=None, dump_interval=60.):
+  """
+    Starts collecting per-key call counts, refresh hits and misses, decode times and write latencies in this process.
+    Returns the ParamsStats: call .snapshot() for a json-able dict, or pass dump_path to also have it written there
+    every dump_interval seconds and at exit. Also enabled at import by setting OP_PARAMS_STATS to a dump path.
+  """
+  global _stats
+  if _stats is None:
+    from common.op_params_stats import ParamsStats
+    from common.op_params_codec import _load_orjson
+    _load_orjson()  # so the first decode time is the decode, not the import
+    _stats = ParamsStats()
+  if dump_path is not None:
+    _stats.start_dumping(dump_path, dump_interval)
+  return _stats
+
+
+def disable_stats():
+  global _stats
+  if _stats is not None:
+    _stats.stop_dumping()
+    _stats = None
+
+
+if os.environ.get('OP_PARAMS_STATS'):  # profile any process without changing its code
+  enable_stats(os.environ['OP_PARAMS_STATS'])
+
+
+_lock = threading.RLock()
+_lock_file = None
+_lock_depth = 0
+_lock_shared = False
+
+
+@contextmanager
+def _params_lock(shared=False):
+  """
+    Advisory lock so batched readers never see half of a batched write. Reentrant within a process (flock locks
+    from two open() calls in one process would deadlock), the outermost caller decides if it's shared. So writing
+    while holding it shared would hold it shared, raises instead: reads collect what to write until after.
+  """
+  global _lock_file, _lock_depth, _lock_shared
+  with _lock:
+    if _lock_depth > 0 and _lock_shared and not shared:
+      raise Exception('opParams: Can\'t take the params lock exclusively while holding it shared')
+    while _lock_depth == 0:
+      _lock_file = open(LOCK_PATH, 'a')
+      fcntl.flock(_lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+      try:
+        if os.fstat(_lock_file.fileno()).st_ino == os.stat(LOCK_PATH).st_ino:
+          _lock_shared = shared
+          break
+      except FileNotFoundError:
+        pass
+      _lock_file.close()  # the profile was switched while we waited, so this lock no longer guards PARAMS_DIR
+    _lock_depth += 1
+    try:
+      yield
+    finally:
+      _lock_depth -= 1
+      if _lock_depth == 0:
+        _lock_file.close()  # releases the flock
+        _lock_file = None
+
+
+def _boot_id():
+  try:
+    with open(BOOT_ID_PATH, 'r') as f:
+      return f.read().strip()
+  except OSError:
+    return None
+
+
+def _read_init_marker():
+  try:
+    with open(INIT_MARKER_PATH, 'r') as f:
+      return f.read()
+  except OSError:
+    return None
 
 
 def _import_params():
@@ -79,111 +558,846 @@ def _import_params():
       pass
 
 
+_OP_EDIT_PARAMS = {  # two required parameters for opEdit
+  'username': Param(None, [type(None), str, bool], 'Your identifier provided with any crash logs sent to Sentry.\nHelps the developer reach out to you if anything goes wrong'),
+  'op_edit_live_mode': Param(False, bool, 'This parameter controls which mode opEdit starts in', hidden=True),
+}
+
+FORK_PARAMS = {  # see opParams.__init__ for how to add your own
+  'camera_offset': Param(0.06, NUMBER, 'Your camera offset to use in lane_planner.py', live=True),  # this updates every sec
+  'a_toggle_param': Param(False, bool, 'A toggle for a feature'),  # with no live or static specified, this updates every 10 sec
+  'a_static_toggle': Param(False, bool, 'Another toggle for a feature, gotten on start up', static=True),  # this is only read once when opParams in initialized
+  **_OP_EDIT_PARAMS,
+}
+
+
 class opParams:
-  def __init__(self):
+  def __init__(self, watch=False, packed=False, shared=False, lazy=False, write_behind=False, flush_interval=0.5, codec='json',
+               journal=False):
     """
-      To add your own parameter to opParams in your fork, simply add a new entry in self.fork_params, instancing a new Param class with at minimum a default value.
+      To add your own parameter to opParams in your fork, simply add a new entry in FORK_PARAMS above, instancing a new Param class with at minimum a default value.
+      FORK_PARAMS is built once when this module is imported and shared by every opParams instance, Params can't be changed.
       The allowed_types and description args are not required but highly recommended to help users edit their parameters with opEdit safely.
         - The description value will be shown to users when they use opEdit to change the value of the parameter.
         - The allowed_types arg is used to restrict what kinds of values can be entered with opEdit so that users can't crash openpilot with unintended behavior.
           (setting a param intended to be a number with a boolean, or viceversa for example)
-          Limiting the range of floats or integers is still recommended when `.get`ting the parameter.
+        - Constraints are checked once when a value is loaded or put, never on .get():
+            min_val, max_val: range for numbers (or for each number of a list). Out of range values are rejected by .put()
+              and clamped when read from disk, pass clamp=False to use the default instead
+            choices: list of the only values allowed, length: required length of a list param
+            predicate: a function that returns True if the value is valid, for anything else
           When a None value is allowed, use `type(None)` instead of None, as opEdit checks the type against the values in the arg with `isinstance()`.
         - If you want your param to update within a second, specify live=True. If your param is designed to be read once, specify static=True.
-          Specifying neither will have the param update every 10 seconds if constantly .get()
+          Specifying neither will have the param update every 10 seconds if constantly .get(), or pass read_frequency=seconds.
+          Params that haven't changed in a while are read less often (up to 4x), until they change or opEdit is in live mode.
           If the param is not static, call the .get() function on it in the update function of the file you're reading from to use live updating
 
       Here's an example of a good fork_param entry:
-      self.fork_params = {'camera_offset': Param(0.06, allowed_types=NUMBER), live=True}  # NUMBER allows both floats and ints
+      FORK_PARAMS = {'camera_offset': Param(0.06, allowed_types=NUMBER, min_val=-0.5, max_val=0.5, live=True)}  # NUMBER allows both floats and ints
+
+      For numeric lists, like breakpoints and values for interp, use ArrayParam or TableParam. They're stored as binary
+      and returned as read-only numpy arrays that are only rebuilt when the stored values change:
+      'steer_ratio_table': TableParam([[0., 20., 40.], [15., 14.5, 14.]], 'Steer ratio by speed (m/s)', min_val=5, max_val=25, live=True)
+
+      Pass watch=True to have a background inotify thread reload params as soon as their files change,
+      making .get() a pure in-memory lookup. Falls back to the read_frequency timer when inotify isn't available.
+      Pass packed=True to keep all params in a single mmap-read file instead of one file per key (see PackedStore).
+      Existing per-key params are migrated into it the first time, after which every process uses it (opEdit too).
+      Pass shared=True to read non-static params from a shared memory snapshot, so polling cost doesn't grow with the
+      number of processes. Once it exists, every instance publishes its writes to it (opEdit too), and
+      common/op_params_shm.py publishes param files edited by hand.
+
+      To read or change several related params at once, use .get_many(keys) and .put_many(dict) (or the .transaction()
+      context manager): they refresh and write in one batch, and batched readers never see half of a batched write.
+      To react to changes instead of comparing values, use .subscribe(keys, callback) or .version() and .changed_since(version).
+      Whole sets of values can be saved, compared and switched atomically with .save_profile(name), .diff_profiles(a, b)
+      and .switch_profile(name).
+
+      Pass lazy=True to do no I/O on construction: each param is read on its first .get(), and the pass that migrates
+      old params, writes missing defaults and deletes/resets params only runs once per boot for all processes.
+
+      Pass write_behind=True for tools that .put() many times a second: puts update this instance right away and are
+      written by a background thread every flush_interval seconds, keeping only the newest value of each key.
+      Call .flush() to write them now; anything still queued is flushed when the interpreter exits cleanly.
+
+      Pass codec='binary' to write param files in a compact binary format that's faster to read than json, mostly for
+      long lists. Every file starts with a header naming its format, so files in any format (and plain json files) are
+      always readable, whatever codec this instance writes with. Reading json uses orjson when it's installed.
+
+      Pass journal=True to record every write (puts, defaults, resets and profile switches) with its time, old and
+      new values in an append-only journal, community/params.journal. .params_at(time.time() - 60) replays it to
+      the values at any time, .history(since, until) lists the changes. Each batch is journaled before its files
+      are written, so one interrupted by a crash is completed by the next journaled process. Once the journal exists,
+      every instance keeps it (opEdit too), so no write is missing from the history. The journal is compacted into a
+      checkpoint as it grows, or with .compact_journal(before).
     """
 
-    self.fork_params = {
-      'camera_offset': Param(0.06, NUMBER, 'Your camera offset to use in lane_planner.py', live=True),  # this updates every sec
-      'a_toggle_param': Param(False, bool, 'A toggle for a feature'),  # with no live or static specified, this updates every 10 sec
-      'a_static_toggle': Param(False, bool, 'Another toggle for a feature, gotten on start up', static=True),  # this is only read once when opParams in initialized
-    }
+    self.fork_params = FORK_PARAMS
 
     self._to_delete = ['alca_min_speed', 'alca_nudge_required']  # a list of unused params you want to delete from users' params file
     self._to_reset = []  # a list of params you want reset to their default values
+    if codec not in CODECS:
+      raise Exception('opParams: Unknown codec: {}'.format(codec))
+    self._codec = codec
+    self._watch = watch
+    self._watcher = None
+    self._packed = packed
+    self._store = None  # opened once this instance or any other process packs the params, see _detect_layout
+    self._shared_enabled = shared
+    self._shared = None
+    self._publisher = None  # the segment, when this instance only publishes its writes to it
+    self._journal_enabled = journal  # also journals once any process created the journal, see _journaling
+    self._journal = None  # opened on first use
+    self._shared_sequence = None
+    self._handles = {}
+    self._file_stats = {}  # key: stat of the file self.params[key] was read from, per-key files only
+    self._dir_stat = None  # stat of PARAMS_DIR at the last full load
+    self._loaded_generation = None  # packed store generation at the last full load
+    self._profile_link = False  # stat of the PARAMS_DIR symlink, False until first checked
+    self._scheduler = RefreshScheduler()
+    self._subscribers = []  # (keys or None for all, callback)
+    self._version = 0
+    self._changed_at = {}  # key: self._version it last changed at
+    self._last_read = {}  # key: when it was last refreshed
+    self._last_generation = {}  # key: packed store generation it was last read at
+    self.params = {}
+    self._lazy = lazy
+    self._initialized = False
+    self._writer = None
+    if write_behind:
+      from common.op_params_writer import WriteBehindQueue
+      self._writer = WriteBehindQueue(self._flush_writes, flush_interval, on_error=lambda e: error('Writing params failed: {}'.format(e)))
     self._run_init()  # restores, reads, and updates params
 
   def _run_init(self):  # does first time initializing of default params
-    # Two required parameters for opEdit
-    self.fork_params['username'] = Param(None, [type(None), str, bool], 'Your identifier provided with any crash logs sent to Sentry.\nHelps the developer reach out to you if anything goes wrong')
-    self.fork_params['op_edit_live_mode'] = Param(False, bool, 'This parameter controls which mode opEdit starts in', hidden=True)
+    if not _OP_EDIT_PARAMS.keys() <= self.fork_params.keys():  # a schema of your own, without the ones opEdit needs
+      self.fork_params = {**self.fork_params, **_OP_EDIT_PARAMS}
 
+    if self._lazy:
+      self.params = {}  # everything else waits for first use, see _ensure_initialized
+      return
     self.params = self._load_params(can_import=True)
-    self._add_default_params()  # adds missing params and resets values with invalid types to self.params
-    self._delete_and_reset()  # removes old params
+    if self._journaling():
+      with _params_lock():
+        if self._open_journal():  # finished a write a crash interrupted, so what we loaded may be older
+          self.params = self._load_params()
+    self._init_pass(self._init_marker())
+    for key, param in self.fork_params.items():  # if another process already did the pass, don't rely on it for our values
+      if key not in self.params:
+        self.params[key] = param.default_copy()
+    self._start_backends()
+
+  def _ensure_initialized(self):  # lazy mode: runs the init pass if no process did yet this boot
+    if self._initialized:
+      return
+    marker = self._init_marker()
+    if marker is None or _read_init_marker() != marker:
+      self.params = self._load_params(can_import=True)  # creates PARAMS_DIR and imports old params like an eager start
+      self._init_pass(marker)
+    else:
+      self._detect_layout()
+    self._start_backends()
+
+  def _init_pass(self, marker):  # writes defaults and deletes/resets params, once per boot across all processes
+    if marker is not None and _read_init_marker() == marker:
+      return
+    with _params_lock():
+      if marker is None or _read_init_marker() != marker:  # another process may have finished the pass while we waited
+        self._add_default_params()  # adds missing params to self.params
+        self._delete_and_reset()  # removes old params
+        if marker is not None:
+          self._write_init_marker(marker)
+
+  def _init_marker(self):  # changes every boot and whenever the schema changes, None if the boot can't be identified
+    boot_id = _boot_id()
+    if boot_id is None:
+      return None
+    schema = [(k, p.default_value, sorted(t.__name__ for t in p.allowed_types), p.is_list, p.describe_constraints()) for k, p in sorted(self.fork_params.items())]
+    return '{} {:08x}'.format(boot_id, zlib.crc32(repr((schema, self._to_delete, self._to_reset)).encode()))
+
+  def _write_init_marker(self, marker):
+    from atomicwrites import atomic_write
+    with atomic_write(INIT_MARKER_PATH, overwrite=True) as f:
+      f.write(marker)
+    os.chmod(INIT_MARKER_PATH, 0o666)
+
+  def _start_backends(self):
+    self._initialized = True
+    if self._watch:
+      self._start_watcher()
+    if self._shared_enabled:
+      self._start_shared()
+    if self._watcher is None and self._shared is None:
+      self._schedule_live_mode()
+
+  def _schedule_live_mode(self):  # opEdit's live mode tightens refreshes, so always watch it
+    param = self.fork_params['op_edit_live_mode']
+    self._scheduler.add('op_edit_live_mode', param.read_frequency, self._last_read.get('op_edit_live_mode', -1) + param.read_frequency, backoff=False)
+
+  def _detect_layout(self):
+    """
+      The layout on disk decides, not this instance's args: once any process packed the params, every process reads
+      and writes the store. The migration removes the per-key files, so readers notice when a read fails, watchers
+      when the packed file appears, and writers check before every write.
+    """
+    if self._store is not None or not (self._packed or os.path.exists(PACKED_PATH)):
+      return
+    from common.op_params_store import PackedStore
+    self._store = PackedStore(PACKED_PATH)
+    self._last_generation.clear()
+    self._file_stats.clear()
+    self._dir_stat = None
+    self._loaded_generation = None
+    if self._watcher is not None:  # readers of the packed store only compare its generation, nothing to watch
+      self._watcher.stop()
+      self._watcher = None
+      if self._shared is None:
+        self._schedule_live_mode()
 
   def get(self, key=None, *, force_update=False):  # key=None returns dict of all params
     if key is None:
       return self._get_all_params(to_update=force_update)
     self._check_key_exists(key, 'get')
+    if _stats is not None:
+      _stats.key(key).gets += 1
     param_info = self.fork_params[key]
-    rate = param_info.read_frequency  # will be None if param is static, so check below
+    if force_update or key not in self.params:  # not loaded yet in lazy mode
+      self._ensure_initialized()
+      self._refresh_param(key)
+    else:
+      self._maybe_refresh(key, param_info)
+
+    return self.params[key]  # validated (and clamped to range) by Param.normalize when it was loaded or put
 
-    if (not param_info.static and sec_since_boot() - self.fork_params[key].last_read >= rate) or force_update:
-      value, success = _read_param(key)
-      self.fork_params[key].last_read = sec_since_boot()
-      if not success:  # in case of read error, use default and overwrite param
-        value = param_info.default_value
-        _write_param(key, value)
-      self.params[key] = value
+  def get_many(self, keys, *, force_update=False):  # if any of keys is due, all of them are read in one locked pass
+    keys = list(keys)
+    for key in keys:
+      self._check_key_exists(key, 'get')
+    self._ensure_initialized()
+    if force_update or any(key not in self.params for key in keys):  # not loaded yet in lazy mode
+      self._refresh_params([k for k in keys if force_update or k not in self.params or not self.fork_params[k].static], lock=True)
+    if not force_update:
+      if self._shared is not None:
+        self._update_from_shared()
+      elif self._watcher is None:
+        self._refresh_together([k for k in keys if not self.fork_params[k].static])
 
-    if param_info.is_valid(value := self.params[key]):
-      return value  # all good, returning user's value
-    print(warning('User\'s value type is not valid! Returning default'))  # somehow... it should always be valid
-    return param_info.default_value  # return default value because user's value of key is not in allowed_types to avoid crashing openpilot
+    params = self.params  # the watcher thread swaps in whole batches, so read one version of it
+    return {key: params[key] for key in keys}
+
+  def handle(self, key):
+    """Returns a ParamHandle for key, for reading a param many times per second with minimal overhead"""
+    self._check_key_exists(key, 'get')
+    if key not in self._handles:
+      self.get(key)  # makes sure it's loaded
+      self._handles[key] = ParamHandle(self, key)
+    return self._handles[key]
 
   def put(self, key, value):
     self._check_key_exists(key, 'put')
-    if not self.fork_params[key].is_valid(value):
-      raise Exception('opParams: Tried to put a value of invalid type!')
-    self.params.update({key: value})
-    _write_param(key, value)
+    self._check_value(key, value)
+    if _stats is not None:
+      _stats.key(key).puts += 1
+    self._ensure_initialized()
+    value = self._set_value(key, value)
+    if self._writer is not None:
+      self._writer.put({key: value})
+      return
+    self._write(key, value)
+    self._publish({key: value})
+
+  def put_many(self, params):  # validates every value first, then writes them all in one step
+    for key, value in params.items():
+      self._check_key_exists(key, 'put')
+      self._check_value(key, value)
+      if _stats is not None:
+        _stats.key(key).puts += 1
+    if not params:
+      return
+    self._ensure_initialized()
+    params = self._set_values(params)
+    if self._writer is not None:
+      self._writer.put(params)  # flushed together, so still all or nothing
+      return
+    self._flush_writes(params)
+
+  def flush(self):  # writes any queued write-behind puts now
+    if self._writer is not None:
+      self._writer.flush()
+
+  def _flush_writes(self, params):
+    self._write_many(params)
+    self._publish(params)
+
+  @contextmanager
+  def transaction(self):
+    """
+      Collects changes and commits them with .put_many() on exit, nothing is written if the block raises:
+        with op_params.transaction() as params:
+          params['steer_kp'] = 0.2
+          params['steer_ki'] = 0.05
+    """
+    changes = {}
+    yield changes
+    self.put_many(changes)
+
+  def _is_cached(self, key):  # True if .get(key) would be answered from memory, without any file I/O
+    if not self._initialized or key not in self.params:
+      return False
+    if self.fork_params[key].static or self._watcher is not None:
+      return True
+    if self._shared is not None:  # a shared memory read, but the snapshot may have moved on since our last look
+      return self._shared.sequence() == self._shared_sequence
+    return key in self._scheduler and sec_since_boot() < self._scheduler.next_due
+
+  def _maybe_refresh(self, key, param_info):
+    if param_info.static:
+      return
+    if self._shared is not None:
+      self._update_from_shared()
+    elif self._watcher is None:  # with a watcher running, non-static params are already up to date in self.params
+      if key not in self._scheduler:  # only params this process uses are refreshed
+        self._schedule(key)
+      now = sec_since_boot()
+      if now >= self._scheduler.next_due:
+        self._refresh_due(now)
+
+  def _refresh_together(self, keys):  # keys read at different times or backed off differently would get out of step
+    for key in keys:
+      if key not in self._scheduler:
+        self._schedule(key)
+    now = sec_since_boot()
+    if now >= self._scheduler.next_due:
+      self._refresh_due(now, keys)
+
+  def _schedule(self, key):
+    if 'op_edit_live_mode' not in self._scheduler:  # not scheduled yet if we just fell back from a watcher that died
+      self._schedule_live_mode()
+    if key not in self._scheduler:
+      param_info = self.fork_params[key]
+      self._scheduler.add(key, param_info.read_frequency, self._last_read.get(key, -1) + param_info.read_frequency)
+
+  def _refresh_due(self, now, together=()):  # refreshes every scheduled key that's due in one pass, and all of together if one of them is
+    keys = self._scheduler.pop_due(now)
+    if together:
+      due = set(keys)
+      if any(key in due for key in together):
+        keys += [key for key in together if key not in due]
+    version = self._version
+    try:
+      if self._profile_switched():  # every param may have changed, read them all in one pass
+        self._replace_params(self._load_params())
+        return
+      self._refresh_params(keys, lock=len(keys) > 1)  # so a batched write is never seen half done
+    finally:
+      for key in keys:
+        self._scheduler.reschedule(key, self._changed_at.get(key, 0) > version, now)
+    if 'op_edit_live_mode' in keys:
+      self._scheduler.set_live_tuning(self.params.get('op_edit_live_mode') is True, now)
+
+  def subscribe(self, keys, callback):
+    """
+      Calls callback(changes) with a dict of the new values whenever any of keys changes (keys=None for every param).
+      Changes are noticed wherever this instance loads values: .get() refreshes, the watcher thread, the shared
+      snapshot, and puts. So callbacks may run on the watcher thread, and a batched put is one call.
+      A param loaded for the first time isn't a change. Returns callback, so it can be used as a decorator.
+    """
+    if keys is not None:
+      keys = [keys] if isinstance(keys, str) else keys
+      for key in keys:
+        self._check_key_exists(key, 'subscribe to')
+      keys = frozenset(keys)
+    self._subscribers.append((keys, callback))
+    return callback
+
+  def unsubscribe(self, callback):
+    self._subscribers = [s for s in self._subscribers if s[1] is not callback]
+
+  def version(self):  # increases whenever any param of this instance changes, never does I/O
+    return self._version
+
+  def changed_since(self, version, keys=None):
+    """
+      Returns the set of params that changed after version (from .version()). With keys, those that are due are
+      refreshed first, like .get_many(keys), so it can be polled once a cycle instead of getting and comparing values.
+    """
+    if keys is None:
+      return {k for k, v in self._changed_at.copy().items() if v > version}  # the watcher thread may be adding keys
+    self.get_many(keys)
+    return {k for k in keys if self._changed_at.get(k, 0) > version}
+
+  def _set_value(self, key, value):  # Returns the value as stored
+    return self._set_values({key: value})[key]
+
+  def _set_values(self, params, swap=False):
+    """
+      Returns the values as stored, subscribers are notified once for the batch. With swap, the batch replaces self.params
+      in one assignment instead of key by key, so get_many() on another thread never sees half of it.
+    """
+    stored, changes = {}, {}
+    target = dict(self.params) if swap and params else self.params
+    for key, value in params.items():
+      previous = target.get(key)
+      value = stored[key] = self.fork_params[key].normalize(value, previous)
+      if key in target and not _same(previous, value):
+        changes[key] = value
+      target[key] = value
+    self.params = target
+    for key, value in stored.items():
+      if key in self._handles:
+        self._handles[key]._update(value)
+    self._notify(changes)
+    return stored
+
+  def _replace_params(self, params):  # after reloading every param at once
+    previous, self.params = self.params, params
+    self._update_handles()
+    self._notify({k: v for k, v in params.items() if k in previous and not _same(previous[k], v)})
+
+  def _update_handles(self):
+    for key, handle in self._handles.items():
+      if key in self.params:
+        handle._update(self.params[key])
+
+  def _notify(self, changes):
+    if not changes:
+      return
+    self._version += 1
+    for key in changes:
+      self._changed_at[key] = self._version
+    for keys, callback in self._subscribers:
+      subscribed = changes if keys is None else {k: v for k, v in changes.items() if k in keys}
+      if subscribed:
+        try:
+          callback(subscribed)
+        except Exception as e:  # a bad subscriber shouldn't break whoever was loading the value
+          error('Subscriber {} failed: {}'.format(getattr(callback, '__name__', callback), e))
+
+  def _refresh_param(self, key):
+    self._refresh_params([key])
+
+  def _refresh_params(self, keys, lock=False, swap=False):  # re-reads keys and sets them as one batch, lock reads them under the shared lock
+    with _params_lock(shared=True) if lock else nullcontext():
+      values, unreadable = self._reread_many(keys)
+    self._set_refreshed(values, unreadable, swap)
+
+  def _reread_many(self, keys):  # Returns {key: value} of the keys that may have changed, and the keys that can't be read
+    values, unreadable = {}, []
+    for key in keys:
+      value, success = self._reread(key)
+      if success:
+        values[key] = value
+      elif success is not None:
+        unreadable.append(key)
+    return values, unreadable
+
+  def _set_refreshed(self, values, unreadable, swap=False):  # call without the shared lock, resetting unreadable keys writes
+    for key in unreadable:  # in case of read error, use default and overwrite param
+      values[key] = self._reset_unreadable(key)
+    version = self._version
+    self._set_values(values, swap)
+    if _stats is not None:
+      for key in values:
+        _stats.refreshed(key, self._changed_at.get(key, 0) > version)
+
+  def _reread(self, key):  # Returns value, success. success is None if key can't have changed since our last read
+    self._last_read[key] = sec_since_boot()
+    if self._writer is not None and self._writer.is_pending(key):  # the file is older than our queued value
+      return None, None
+    if self._store is None:
+      return self._read_if_changed(key)
+    generation = self._store.generation()
+    if generation == self._last_generation.get(key):  # nothing in the store changed since our last read
+      if _stats is not None:
+        _stats.refreshed(key, False)
+      return None, None
+    self._last_generation[key] = generation
+    return self._read(key)
+
+  def _read_if_changed(self, key):  # a stat instead of reading and parsing the file if it didn't change since our last read
+    try:
+      st = os.stat(os.path.join(PARAMS_DIR, key))
+    except FileNotFoundError:
+      self._file_stats.pop(key, None)
+      return None, False
+    if key in self.params and self._file_stats.get(key) == _stat_key(st):
+      return self.params[key], True
+    value, success = _read_param(key)  # if it's replaced after the stat, the next stat won't match and we read again
+    if success and _settled(st):
+      self._file_stats[key] = _stat_key(st)
+    else:
+      self._file_stats.pop(key, None)
+    return value, success
+
+  def _reset_unreadable(self, key):  # writes the default, unless another process fixed the param since our failed read
+    with _params_lock():
+      self._detect_layout()  # or packed all params since
+      value, success = self._read(key)
+      if success:
+        return value
+      value = self.fork_params[key].default_copy()
+      self._write(key, value, 'reset')
+      return value
+
+  def key_version(self, key):
+    """
+      Returns a token that changes whenever key is written by any process (None if it doesn't exist yet).
+      Pass it to .compare_and_put() to only write if nobody else changed the param since you read it.
+    """
+    self._check_key_exists(key, 'get')
+    if self._store is not None:
+      return self._store.generation()  # the store is written as a whole, so this is coarser than per key
+    try:
+      st = os.stat(os.path.join(PARAMS_DIR, key))
+    except FileNotFoundError:
+      return None
+    return st.st_ino, st.st_mtime_ns, st.st_size  # every atomic_write creates a new inode
+
+  def compare_and_put(self, key, value, version):  # Returns False without writing if key's version changed
+    self._check_key_exists(key, 'put')
+    self._check_value(key, value)
+    self._ensure_initialized()
+    self.flush()  # the version has to reflect our own queued writes
+    with _params_lock():
+      if self.key_version(key) != version:
+        return False
+      value = self._set_value(key, value)
+      self._write(key, value)
+    self._publish({key: value})
+    return True
+
+  def _read(self, key):
+    if self._store is not None:
+      return self._store.read(key)
+    return _read_param(key)
+
+  def _write(self, key, value, source='put'):
+    self._write_many({key: value}, source)
+
+  def _write_many(self, params, source='put'):
+    with self._journaled(params, source):
+      self._apply(params)
+
+  def _remove_many(self, keys):
+    with self._journaled(dict.fromkeys(keys), 'delete'):
+      self._apply({}, keys)
+
+  def _stored(self, key):  # True if key has a file or packed entry, even one that can't be decoded
+    if self._store is not None:
+      return key in self._store
+    return os.path.lexists(os.path.join(PARAMS_DIR, key))
+
+  def _apply(self, params, removed=()):  # writes params and removes the removed keys, without journaling
+    with _params_lock():
+      self._detect_layout()  # a write must never go to files another process already packed
+      if self._store is not None:
+        self._store.update(_jsonable(params), delete=removed)  # a single atomic write already, the store takes its own lock
+        return
+      if params:
+        _write_params(params, self._codec)
+      for key in removed:
+        try:
+          os.remove(os.path.join(PARAMS_DIR, key))
+        except FileNotFoundError:
+          pass
+
+  @contextmanager
+  def _journaled(self, params, source):  # the change is journaled before the block writes it, and marked done after
+    with _params_lock():
+      if not self._journaling():
+        yield
+        return
+      if self._journal is None:
+        self._open_journal()
+      old = _jsonable({key: self._read(key)[0] for key in params})
+      changes = {k: [old[k], v] for k, v in _jsonable(params).items() if old[k] != v}
+      if not changes:  # rewriting stored values, nothing to record or redo
+        yield
+        return
+      offset = self._journal.append(changes, source)
+      yield
+      self._journal.done(offset)
+      self._journal.maybe_compact()
+
+  def _open_journal(self):  # Returns True if a write interrupted by a crash was finished. Called with the params lock held
+    from common.op_params_journal import Journal
+    self._journal = Journal(JOURNAL_PATH, self._apply)
+    if not self._journal.exists():  # history starts from the values stored now
+      stored = {key: self._read(key) for key in self.fork_params}
+      self._journal.create(_jsonable({key: value for key, (value, success) in stored.items() if success}))
+      return False
+    return len(self._journal.recover()) > 0
+
+  def _journaling(self):  # a journal another process created is kept by every writer, or its history would have gaps
+    return self._journal is not None or self._journal_enabled or os.path.exists(JOURNAL_PATH)
+
+  def _use_journal(self):
+    if not self._journaling():
+      raise Exception('opParams: The journal is only kept with opParams(journal=True)')
+    self._ensure_initialized()
+    if self._journal is None:
+      with _params_lock():
+        self._open_journal()
+    return self._journal
+
+  def params_at(self, t):
+    """Returns every param as it was at time t (from time.time()), None if t is older than the journal's history"""
+    state = self._use_journal().state_at(t)
+    if state is None:
+      return None
+    return {k: p.normalize(state[k]) if k in state else p.default_copy() for k, p in self.fork_params.items()}
+
+  def history(self, since=None, until=None):
+    """Returns the journaled changes between two times as a list of (time, source, key, old value, new value)"""
+    return self._use_journal().history(since, until)
+
+  def compact_journal(self, before=None):  # folds history older than before (a time.time()) into the checkpoint
+    journal = self._use_journal()
+    with _params_lock():
+      journal.compact(before)
+
+  def _start_watcher(self):
+    from common.op_params_watcher import ParamsWatcher, inotify_available
+    if self._store is not None:  # readers of the packed store only compare its generation, nothing to watch
+      return
+    if not inotify_available():
+      warning('inotify not available, falling back to timed param reads')
+      return
+    self._watcher = ParamsWatcher(PARAMS_DIR, self._on_files_changed, reload_on=[os.path.basename(PACKED_PATH)], on_exit=self._on_watcher_exit)
+    self._watcher.start()
+
+  def _on_watcher_exit(self, watcher):  # called from the watcher thread if it died, reads fall back to the read_frequency timer
+    if self._watcher is watcher:
+      self._watcher = None
+      error('The params watcher stopped, falling back to timed param reads')
+
+  def _on_files_changed(self, keys):  # called from the watcher thread, keys is None if the profile was switched, packed or events were lost
+    if keys is not None:
+      with _params_lock(shared=True):  # a batched write renames all its files holding this exclusively, so they're all in place now
+        watcher = self._watcher
+        if watcher is not None:
+          keys = watcher.pending(keys)  # and the events for the rest of the batch have arrived
+        if keys is not None:
+          values, unreadable = self._reread_many([k for k in keys if k in self.fork_params and not self.fork_params[k].static])
+    if keys is None:
+      self._replace_params(self._load_params())
+    else:
+      self._set_refreshed(values, unreadable, swap=True)  # subscribers may put, so not under the shared lock
+
+  def _start_shared(self):
+    from common.op_params_shm import SharedParams  # only processes that want it pay for multiprocessing
+    self._shared = SharedParams(SHM_LOCK_PATH)
+    if self._shared.created or self._shared.sequence() == 0:
+      self._publish(self.params, replace=True)
+    self._update_from_shared()
+
+  def _publish(self, params, replace=False):
+    shared = self._shared if self._shared is not None else self._shared_publisher()
+    if shared is not None:
+      shared.publish(_jsonable(params), replace=replace)
+
+  def _shared_publisher(self):  # like the packed layout, what exists decides: opEdit's puts have to reach shared readers too
+    if self._publisher is None and os.path.exists(SHM_PATH):
+      from common.op_params_shm import SharedParams
+      self._publisher = SharedParams(SHM_LOCK_PATH)
+    return self._publisher
+
+  def _update_from_shared(self):
+    snapshot = self._shared.snapshot(self._shared_sequence)
+    if snapshot is None:  # nothing published since our last look
+      return
+    self._shared_sequence, shared_params = snapshot
+    self._set_values({key: value for key, value in shared_params.items() if key in self.fork_params and not self.fork_params[key].static
+                      and (self._writer is None or not self._writer.is_pending(key))})
+
+  def sync_shared(self):  # reloads params from disk and publishes them for all shared readers
+    self._ensure_initialized()
+    self.flush()
+    self._replace_params(self._load_params())
+    self._publish(self.params, replace=True)
 
   def _load_params(self, can_import=False):
     if not os.path.exists(PARAMS_DIR):
       os.makedirs(PARAMS_DIR)
       if can_import:
         _import_params()  # just imports old params. below we read them in
+    self._profile_switched()  # reopens the packed store if needed
+    self._detect_layout()
 
-    params = {}
-    for key in os.listdir(PARAMS_DIR):  # PARAMS_DIR is guaranteed to exist
-      if key.startswith('.') or key not in self.fork_params:
-        continue
-      value, success = _read_param(key)
-      if not success:
-        value = self.fork_params[key].default_value
-        _write_param(key, value)
-      params[key] = value
+    if self._store is not None:
+      if can_import and not self._store.exists():
+        with _params_lock():
+          if not self._store.exists():  # one time move from one file per key
+            self._store.migrate_from_dir(PARAMS_DIR, decode=_decode_jsonable)
+            for key in os.listdir(PARAMS_DIR):  # so per-key readers fail their next read and switch to the store
+              if not key.startswith('.'):
+                os.remove(os.path.join(PARAMS_DIR, key))
+      generation = self._store.generation()  # read first: a write after it makes the next load read everything again
+      if generation == self._loaded_generation:
+        return dict(self.params)  # nothing was written since the last full load
+      params = {k: self.fork_params[k].normalize(v, self.params.get(k)) for k, v in self._store.read_all().items() if k in self.fork_params}
+      self._loaded_generation = generation
+      return params
+
+    # every write (ours, opEdit's or another process's) replaces the file, which changes the directory's mtime.
+    # files edited in place by hand are still noticed by per-key refreshes, just not by this check
+    st = os.stat(PARAMS_DIR)
+    if self._dir_stat == _stat_key(st):
+      return dict(self.params)  # nothing was written since the last full load
+    self._dir_stat = _stat_key(st) if _settled(st) else None
+
+    params, unreadable = {}, []
+    with _params_lock(shared=True):
+      for key in os.listdir(PARAMS_DIR):  # PARAMS_DIR is guaranteed to exist
+        if key.startswith('.') or key not in self.fork_params:
+          continue
+        value, success = self._read_if_changed(key)
+        if success:
+          params[key] = self.fork_params[key].normalize(value, self.params.get(key))
+        else:
+          unreadable.append(key)
+    for key in unreadable:  # fixed after releasing the shared lock, writing needs it exclusively
+      params[key] = self._reset_unreadable(key)
     return params
 
   def _get_all_params(self, to_update=False):
-    if to_update:
-      self.params = self._load_params()
+    self._ensure_initialized()
+    if to_update or len(self.params) < len(self.fork_params):  # lazy mode hasn't loaded every param yet
+      self.flush()
+      self._replace_params(self._load_params())
     return {k: self.params[k] for k, p in self.fork_params.items() if k in self.params and not p.hidden}
 
+  def profiles(self):
+    return _profiles_module().list_profiles(PROFILES_DIR)
+
+  def active_profile(self):  # None until a profile is saved or switched to
+    return _profiles_module().active_profile(PARAMS_DIR)
+
+  def save_profile(self, name):
+    """
+      Saves the current value of every param as profile name, replacing it if it exists. The first time, the params
+      directory itself becomes the 'default' profile (saving the active profile is a no-op, it's always up to date).
+    """
+    profiles = _profiles_module()
+    profiles.check_name(name)
+    self._ensure_initialized()
+    self.flush()
+    self._get_all_params(to_update=True)
+    params = {k: self.params.get(k, p.default_value) for k, p in self.fork_params.items()}
+    with _params_lock():
+      profiles.migrate(PARAMS_DIR, PROFILES_DIR)
+      if name != profiles.active_profile(PARAMS_DIR):
+        profiles.save(PROFILES_DIR, name, lambda path: self._write_profile(path, params))
+
+  def switch_profile(self, name):
+    """
+      Makes profile name the active one with a single atomic symlink swap. This instance reloads right away, other
+      processes pick up every value of the new profile in one pass on their next refresh.
+    """
+    profiles = _profiles_module()
+    self._check_profile_exists(name)
+    self._ensure_initialized()
+    self.flush()
+    with _params_lock():
+      profiles.migrate(PARAMS_DIR, PROFILES_DIR)
+      active = profiles.active_profile(PARAMS_DIR)
+      if name != active:
+        if self._journaling():  # a switch is already atomic, journaled as done so it's never redone
+          old, new = self._read_profile(active), self._read_profile(name)
+          changed = [k for k in self.fork_params if not _equal(old[k], new[k])]
+          old, new = _jsonable(old), _jsonable(new)
+          if changed:
+            self._use_journal().append({k: [old[k], new[k]] for k in changed}, 'switch', done=True)
+        profiles.switch(PARAMS_DIR, PROFILES_DIR, name)
+    self._replace_params(self._load_params())
+    self._publish(self.params, replace=True)
+
+  def diff_profiles(self, a, b=None):
+    """Returns {key: (value in a, value in b)} for every param that differs, b=None compares against the current params"""
+    values_a = self._read_profile(a)
+    if b is None:
+      self._get_all_params(to_update=True)
+      values_b = {k: self.params[k] if k in self.params else p.default_copy() for k, p in self.fork_params.items()}
+    else:
+      values_b = self._read_profile(b)
+    return {k: (values_a[k], values_b[k]) for k in self.fork_params if not _equal(values_a[k], values_b[k])}
+
+  def _check_profile_exists(self, name):
+    _profiles_module().check_name(name)
+    if not os.path.isdir(os.path.join(PROFILES_DIR, name)):
+      raise Exception('opParams: Unknown profile: {}'.format(name))
+
+  def _read_profile(self, name):  # Returns the value each param would have in profile name
+    self._check_profile_exists(name)
+    path = os.path.join(PROFILES_DIR, name)
+    if self._store is not None:
+      from common.op_params_store import PackedStore
+      store = PackedStore(os.path.join(path, os.path.basename(PACKED_PATH)))
+      values = store.read_all() if store.exists() else {}
+    else:
+      values = {}
+      for key in os.listdir(path):
+        if key in self.fork_params:
+          value, success = _read_param(key, path)
+          if success:
+            values[key] = value
+    return {k: p.normalize(values[k]) if k in values else p.default_copy() for k, p in self.fork_params.items()}
+
+  def _write_profile(self, path, params):  # writes params in the layout this instance reads
+    if self._store is not None:
+      from common.op_params_store import PackedStore
+      PackedStore(os.path.join(path, os.path.basename(PACKED_PATH))).update(_jsonable(params))
+    else:
+      _write_params(params, self._codec, path)
+
+  def _profile_switched(self):  # one lstat: True if PARAMS_DIR points at a different profile since the last check
+    link = _link_stat(PARAMS_DIR)  # inline, so processes that never use profiles never import them
+    if link == self._profile_link:
+      return False
+    switched = self._profile_link is not False
+    self._profile_link = link
+    if switched:
+      self._dir_stat = None
+      self._file_stats.clear()
+      if self._store is not None:  # the packed file of the new profile
+        from common.op_params_store import PackedStore
+        self._store = PackedStore(PACKED_PATH)
+        self._last_generation.clear()
+        self._loaded_generation = None
+    return switched
+
   def _check_key_exists(self, key, met):
     if key not in self.fork_params:
       raise Exception('opParams: Tried to {} an unknown parameter! Key not in fork_params: {}'.format(met, key))
 
-  def _add_default_params(self):
+  def _check_value(self, key, value):  # puts are strict, out of range values raise instead of being clamped
+    reason = self.fork_params[key].check(value)
+    if reason is not None:
+      raise Exception('opParams: Tried to put an invalid value! ({}: {})'.format(key, reason))
+
+  def _add_default_params(self):  # called with the params lock held
+    defaults = {}
     for key, param in self.fork_params.items():
-      if key not in self.params:
-        self.params[key] = param.default_value
-        _write_param(key, self.params[key])
-      elif not param.is_valid(self.params[key]):
-        print(warning('Value type of user\'s {} param not in allowed types, replacing with default!'.format(key)))
-        self.params[key] = param.default_value
-        _write_param(key, self.params[key])
-
-  def _delete_and_reset(self):
-    for key in list(self.params):
-      if key in self._to_delete:
-        del self.params[key]
-        os.remove(os.path.join(PARAMS_DIR, key))
-      elif key in self._to_reset and key in self.fork_params:
-        self.params[key] = self.fork_params[key].default_value
-        _write_param(key, self.params[key])
+      if key in self.params and not _equal(self.params[key], param.default_value):  # invalid values were loaded as the default
+        continue
+      value, success = self._read(key)  # re-read under the lock, another process may have written it since we loaded
+      if success and param._usable(value):
+        self.params[key] = param.normalize(value)
+        continue
+      if success:  # so not every process has to warn and fall back to the default, forever
+        warning('Value of user\'s {} param is not valid, replacing it with the default!'.format(key))
+      defaults[key] = param.default_copy()
+    if defaults:
+      self.params.update(defaults)
+      self._write_many(defaults, 'default')
+
+  def _delete_and_reset(self):  # called with the params lock held
+    for key in self._to_delete:  # these are never loaded into self.params
+      self.params.pop(key, None)
+    removed = [key for key in self._to_delete if self._stored(key)]  # usually long gone, so usually no write at all
+    if removed:
+      self._remove_many(removed)
+    resets = {key: self.fork_params[key].default_copy() for key in self._to_reset if key in self.fork_params}
+    if resets:
+      self.params.update(resets)
+      self._write_many(resets, 'reset')
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from common.op_params import opParams
+
+
+class AsyncOpParams:
+  """
+    An asyncio facade over opParams, for daemons that run on an event loop:
+      params = AsyncOpParams(lazy=True)  # any opParams args, or AsyncOpParams(op_params=existing_instance)
+      offset = await params.get('camera_offset')
+      await params.put('camera_offset', 0.1)
+      async for changes in params.changes(['camera_offset']):
+        ...
+    Anything that could touch the filesystem runs on one worker thread (opParams isn't thread safe, so calls are
+    serialized), keeping the loop free during reloads and fsyncs. Values already in memory and not due for a refresh
+    are returned without leaving the loop. The values are those of the wrapped opParams, so both share one cache.
+  """
+  def __init__(self, op_params=None, **kwargs):
+    self.op_params = op_params if op_params is not None else opParams(**kwargs)
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='opParamsAsync')
+
+  async def get(self, key=None, *, force_update=False):
+    if key is not None and not force_update and self.op_params._is_cached(key):
+      return self.op_params.params[key]
+    return await self._run(self.op_params.get, key, force_update=force_update)
+
+  async def get_many(self, keys, *, force_update=False):
+    return await self._run(self.op_params.get_many, keys, force_update=force_update)
+
+  async def put(self, key, value):
+    await self._run(self.op_params.put, key, value)
+
+  async def put_many(self, params):
+    await self._run(self.op_params.put_many, params)
+
+  async def flush(self):
+    await self._run(self.op_params.flush)
+
+  async def changes(self, keys=None, poll_interval=1.):
+    """
+      Yields a dict of new values each time any of keys changes (keys=None for every param). Without a watcher
+      (opParams(watch=True)), the keys are refreshed every poll_interval seconds to notice changes.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    callback = self.op_params.subscribe(keys, lambda changes: loop.call_soon_threadsafe(queue.put_nowait, changes))
+    poller = None
+    if self.op_params._watcher is None:
+      if keys is None:
+        keys = [k for k, p in self.op_params.fork_params.items() if not p.static]
+      poller = asyncio.ensure_future(self._poll([keys] if isinstance(keys, str) else list(keys), poll_interval))
+    try:
+      while True:
+        yield await queue.get()
+    finally:
+      self.op_params.unsubscribe(callback)
+      if poller is not None:
+        poller.cancel()
+
+  async def close(self):  # writes anything queued and stops the worker thread
+    await self.flush()
+    self._executor.shutdown(wait=False)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc):
+    await self.close()
+
+  async def _poll(self, keys, interval):
+    while True:
+      await asyncio.sleep(interval)
+      await self._run(self.op_params.get_many, keys)  # refreshes the due keys, changes reach the queue through subscribe
+
+  def _run(self, fn, *args, **kwargs):
+    return asyncio.get_running_loop().run_in_executor(self._executor, lambda: fn(*args, **kwargs))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+import sys
+import json
+import struct
+
+_UNLOADED = object()
+orjson = _UNLOADED  # a faster json parser, used for reading when it's installed. imported on the first json read
+
+MAGIC = b'\x93OP'  # followed by a codec's tag byte. can't start a json document, so files without it are plain json
+ARRAY_DTYPES = {'float32': b'f', 'float64': b'd'}
+_ARRAY_STORED_DTYPES = {b'f': '<f4', b'd': '<f8'}  # always little-endian on disk
+_ARRAY_HEADER = struct.Struct('<cB')  # dtype char, number of dimensions
+_U32 = struct.Struct('<I')
+_I64 = struct.Struct('<q')
+_F64 = struct.Struct('<d')
+
+
+def _load_orjson():  # Returns the orjson module, or None if it isn't installed
+  global orjson
+  if orjson is _UNLOADED:
+    try:
+      import orjson as module  # about 10 ms, so only processes that read json pay for it
+    except ImportError:
+      module = None
+    orjson = module
+  return orjson
+
+
+def _is_array(value):
+  return 'numpy' in sys.modules and isinstance(value, sys.modules['numpy'].ndarray)
+
+
+class JsonCodec:
+  """Plain json with no header, readable by any version of opParams and easy to edit by hand"""
+  name = 'json'
+  tag = None
+
+  def encode(self, value):
+    return json.dumps(value).encode()  # stdlib for writing, it round trips NaN and big ints exactly
+
+  def decode(self, data, offset=0):
+    parser = _load_orjson()
+    if parser is not None:
+      try:
+        return parser.loads(data)
+      except parser.JSONDecodeError:  # NaN and Infinity, which only the stdlib parser accepts
+        pass  # (orjson also reads ints past 64 bits as floats, no param needs those)
+    return json.loads(data)
+
+
+class BinaryCodec:
+  """
+    Compact msgpack-style encoding: a type byte per value, struct-packed scalars, and lists of only floats or
+    only ints packed as one block so they're decoded with a single struct call.
+  """
+  name = 'binary'
+  tag = b'B'
+
+  def encode(self, value):
+    out = []
+    self._encode(value, out)
+    return b''.join(out)
+
+  def decode(self, data, offset=0):
+    value, offset = self._decode(data, offset)
+    if offset != len(data):
+      raise ValueError('Trailing data after binary param value')
+    return value
+
+  def _encode(self, value, out):
+    t = type(value)
+    if value is None:
+      out.append(b'N')
+    elif t is bool:
+      out.append(b'T' if value else b'F')
+    elif t is int:
+      out.append(b'i' + _I64.pack(value))  # struct.error past 64 bits, encode_value falls back to json
+    elif t is float:
+      out.append(b'd' + _F64.pack(value))
+    elif t is str:
+      encoded = value.encode()
+      out.append(b's' + _U32.pack(len(encoded)) + encoded)
+    elif t is list:
+      if value and all(type(v) is float for v in value):
+        out.append(b'D' + _U32.pack(len(value)) + struct.pack('<{}d'.format(len(value)), *value))
+      elif value and all(type(v) is int for v in value):
+        out.append(b'I' + _U32.pack(len(value)) + struct.pack('<{}q'.format(len(value)), *value))
+      else:
+        out.append(b'l' + _U32.pack(len(value)))
+        for v in value:
+          self._encode(v, out)
+    elif t is dict:
+      out.append(b'm' + _U32.pack(len(value)))
+      for k, v in value.items():
+        if type(k) is not str:
+          raise TypeError('Binary params only support str dict keys')
+        self._encode(k, out)
+        self._encode(v, out)
+    else:
+      raise TypeError('Can\'t encode a {} param'.format(t.__name__))
+
+  def _decode(self, data, offset):  # Returns value, offset after it
+    tag, offset = data[offset:offset + 1], offset + 1
+    if tag == b'd':
+      return _F64.unpack_from(data, offset)[0], offset + 8
+    if tag == b'T' or tag == b'F':
+      return tag == b'T', offset
+    if tag == b'i':
+      return _I64.unpack_from(data, offset)[0], offset + 8
+    if tag == b'N':
+      return None, offset
+    if tag == b'D' or tag == b'I':
+      n = _U32.unpack_from(data, offset)[0]
+      return list(struct.unpack_from('<{}{}'.format(n, 'd' if tag == b'D' else 'q'), data, offset + 4)), offset + 4 + 8 * n
+    if tag == b's':
+      n = _U32.unpack_from(data, offset)[0]
+      offset += 4
+      if offset + n > len(data):
+        raise ValueError('Truncated binary param string')
+      return bytes(data[offset:offset + n]).decode(), offset + n
+    if tag == b'l':
+      n = _U32.unpack_from(data, offset)[0]
+      offset += 4
+      value = []
+      for _ in range(n):
+        v, offset = self._decode(data, offset)
+        value.append(v)
+      return value, offset
+    if tag == b'm':
+      n = _U32.unpack_from(data, offset)[0]
+      offset += 4
+      value = {}
+      for _ in range(n):
+        k, offset = self._decode(data, offset)
+        value[k], offset = self._decode(data, offset)
+      return value, offset
+    raise ValueError('Unknown binary param type: {}'.format(tag))
+
+
+class ArrayCodec:
+  """numpy arrays (ArrayParam, TableParam): dtype, shape, then the raw little-endian values"""
+  name = 'array'
+  tag = b'A'
+
+  def encode(self, value):
+    stored_dtype = _ARRAY_STORED_DTYPES[ARRAY_DTYPES[value.dtype.name]]
+    return _ARRAY_HEADER.pack(ARRAY_DTYPES[value.dtype.name], value.ndim) + \
+      struct.pack('<{}I'.format(value.ndim), *value.shape) + value.astype(stored_dtype, copy=False).tobytes()
+
+  def decode(self, data, offset=0):
+    import numpy as np
+    dtype, ndim = _ARRAY_HEADER.unpack_from(data, offset)
+    shape = struct.unpack_from('<{}I'.format(ndim), data, offset + _ARRAY_HEADER.size)
+    offset += _ARRAY_HEADER.size + 4 * ndim
+    # a view on the file's bytes, so no copy and read-only
+    return np.frombuffer(data, dtype=_ARRAY_STORED_DTYPES[dtype], offset=offset).reshape(shape)
+
+
+JSON = JsonCodec()
+ARRAY = ArrayCodec()
+CODECS = {}  # name: codec, for writing
+_CODECS_BY_TAG = {}  # tag: codec, for reading
+
+
+def register_codec(codec):
+  """Adds a codec: an object with a unique name, a one byte tag, and encode(value) and decode(data, offset) methods"""
+  assert codec.name not in CODECS and codec.tag not in _CODECS_BY_TAG, 'Codec name and tag must be unique'
+  CODECS[codec.name] = codec
+  if codec.tag is not None:
+    _CODECS_BY_TAG[codec.tag] = codec
+
+
+register_codec(JSON)
+register_codec(BinaryCodec())
+_CODECS_BY_TAG[ARRAY.tag] = ARRAY  # not selectable by name, numpy arrays always use it
+
+
+def encode_value(value, codec='json'):  # Returns the file contents for value, arrays always use the array codec
+  codec = ARRAY if _is_array(value) else CODECS[codec]
+  try:
+    payload = codec.encode(value)
+  except (TypeError, ValueError, OverflowError, struct.error):
+    if codec is JSON or codec is ARRAY:
+      raise
+    codec, payload = JSON, JSON.encode(value)  # something the codec can't represent
+  return payload if codec.tag is None else MAGIC + codec.tag + payload
+
+
+def decode_value(data):  # Raises ValueError or struct.error if data can't be decoded
+  if data[:3] == MAGIC:
+    codec = _CODECS_BY_TAG.get(data[3:4])
+    if codec is None:
+      raise ValueError('Unknown param codec: {}'.format(data[3:4]))
+    return codec.decode(data, 4)
+  return JSON.decode(data)
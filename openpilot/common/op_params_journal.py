@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import tempfile
+
+from common.op_params_codec import JSON
+
+MAX_BYTES = 1 << 20  # compacted down to half of this once it grows past it
+PENDING, DONE = b'P', b'D'  # first byte of each record, flipped in place once its files are written
+CHECKPOINT = b'C'  # first line: the state the records after it apply to
+TAIL_CHUNK = 4096
+
+
+class Journal:
+  """
+    Append-only history of param changes, one json record per line:
+      {"t": wall time, "src": "put", "c": {key: [old value, new value], ...}}
+    Each batch of writes is appended and synced before any param file is touched, then marked done. After a crash
+    partway through a batch, the last record is still pending, and recover() writes it again through redo(params,
+    removed). Writers only ever append while holding the exclusive params lock, so only the last record can be pending.
+    The first line is a checkpoint of every value, compaction folds old records into it.
+  """
+  def __init__(self, path, redo):
+    self.path = path
+    self._redo = redo
+
+  def exists(self):
+    return os.path.exists(self.path)
+
+  def size(self):
+    try:
+      return os.path.getsize(self.path)
+    except FileNotFoundError:
+      return 0
+
+  def create(self, params, t=None):  # starts the journal from a checkpoint of params
+    self._rewrite({'t': time.time() if t is None else t, 'params': params}, [])
+
+  def append(self, changes, source, done=False, t=None):
+    """Records {key: (old, new)} durably, returns the record's offset for done(). Call with the params lock held"""
+    self.recover()
+    record = json.dumps({'t': time.time() if t is None else t, 'src': source, 'c': changes}).encode()
+    with open(self.path, 'ab') as f:
+      offset = f.tell()
+      f.write((DONE if done else PENDING) + record + b'\n')
+      f.flush()
+      os.fdatasync(f.fileno())
+    return offset
+
+  def done(self, offset):  # not synced: if this is lost, recovery just writes the same values again
+    with open(self.path, 'r+b') as f:
+      f.seek(offset)
+      f.write(DONE)
+
+  def recover(self):  # Returns the keys written again if the last batch was interrupted. Call with the params lock held
+    last = self._last_record()
+    if last is None or last[1] != PENDING:
+      return []
+    offset, _, record = last
+    if record['src'] == 'delete':
+      self._redo({}, list(record['c']))
+    else:
+      self._redo({key: new for key, (old, new) in record['c'].items()}, [])
+    self.done(offset)
+    return list(record['c'])
+
+  def records(self):  # Yields (status, record) for every record after the checkpoint, which is yielded first
+    with open(self.path, 'rb') as f:
+      for line in f:
+        if not line.endswith(b'\n'):
+          return  # torn by a crash while appending, recover() truncates it
+        yield line[:1], JSON.decode(line[1:])
+
+  def state_at(self, t):  # Returns the params as they were at time t, None if that's before the checkpoint
+    records = self.records()
+    params = self._checkpoint(records)
+    if params is None or params['t'] > t:
+      return None
+    params = params['params']
+    for _, record in records:
+      if record['t'] > t:
+        break
+      _apply(params, record)
+    return params
+
+  def history(self, since=None, until=None):  # Returns [(time, source, key, old, new)] of the records in that range
+    records = self.records()
+    self._checkpoint(records)
+    entries = []
+    for _, record in records:
+      if until is not None and record['t'] > until:
+        break
+      if since is None or record['t'] >= since:
+        entries += [(record['t'], record['src'], key, old, new) for key, (old, new) in record['c'].items()]
+    return entries
+
+  def maybe_compact(self):  # Call with the params lock held
+    if self.size() > MAX_BYTES:
+      self.compact()
+
+  def compact(self, before=None, keep_bytes=None):
+    """
+      Folds every record older than before, and then the oldest records until the rest fits in keep_bytes, into the
+      checkpoint. History that old can no longer be replayed. Call with the params lock held.
+    """
+    keep_bytes = MAX_BYTES // 2 if keep_bytes is None else keep_bytes
+    self.recover()
+    records = self.records()
+    checkpoint = self._checkpoint(records)
+    if checkpoint is None:
+      return
+    records = [record for _, record in records]
+    sizes = [len(json.dumps(record)) + 2 for record in records]
+    remaining, folded = sum(sizes), 0
+    for record, size in zip(records, sizes):
+      if (before is None or record['t'] >= before) and remaining <= keep_bytes:
+        break
+      _apply(checkpoint['params'], record)
+      checkpoint['t'] = record['t']
+      remaining -= size
+      folded += 1
+    if folded:
+      self._rewrite(checkpoint, records[folded:])
+
+  def _checkpoint(self, records):
+    for status, record in records:
+      return record if status == CHECKPOINT else None
+    return None
+
+  def _last_record(self):  # Returns (offset, status, record) of the last complete record, truncating a torn one
+    try:
+      f = open(self.path, 'r+b')
+    except FileNotFoundError:
+      return None
+    with f:
+      end = f.seek(0, os.SEEK_END)
+      data, start = b'', end
+      while start > 0 and data.count(b'\n') < 2:  # the last complete line ends with a newline and starts after another
+        start = max(0, start - TAIL_CHUNK)
+        f.seek(start)
+        data = f.read(end - start)
+      cut = data.rfind(b'\n') + 1
+      if start + cut < end:  # torn by a crash while appending, before any param file was touched
+        f.truncate(start + cut)
+        data = data[:cut]
+      if not data:
+        return None
+      line_start = data.rfind(b'\n', 0, len(data) - 1) + 1
+      line = data[line_start:]
+      return start + line_start, line[:1], JSON.decode(line[1:])
+
+  def _rewrite(self, checkpoint, records):  # replaces the whole file atomically
+    fd, tmp_path = tempfile.mkstemp(prefix='.journal', dir=os.path.dirname(self.path))
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(CHECKPOINT + json.dumps(checkpoint).encode() + b'\n')
+        for record in records:
+          f.write(DONE + json.dumps(record).encode() + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
+      os.chmod(tmp_path, 0o666)
+      os.replace(tmp_path, self.path)
+    except BaseException:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      raise
+
+
+def _apply(params, record):
+  for key, (old, new) in record['c'].items():
+    if record['src'] == 'delete':
+      params.pop(key, None)
+    else:
+      params[key] = new
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import ctypes
+import ctypes.util
+import tempfile
+
+DEFAULT_PROFILE = 'default'  # what the params directory becomes the first time profiles are used
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+def _load_renameat2():
+  if not sys.platform.startswith('linux'):
+    return None
+  try:
+    renameat2 = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True).renameat2  # glibc 2.28+
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    return renameat2
+  except (OSError, AttributeError):
+    return None
+
+
+_renameat2 = _load_renameat2()
+
+
+def check_name(name):
+  if not isinstance(name, str) or not name or name.startswith('.') or os.sep in name:
+    raise Exception('opParams: Invalid profile name: {!r}'.format(name))
+
+
+def list_profiles(profiles_dir):
+  if not os.path.isdir(profiles_dir):
+    return []
+  return sorted(name for name in os.listdir(profiles_dir) if not name.startswith('.') and os.path.isdir(os.path.join(profiles_dir, name)))
+
+
+def active_profile(params_dir):  # None until profiles are used, params_dir is a real directory until then
+  if not os.path.islink(params_dir):
+    return None
+  return os.path.basename(os.readlink(params_dir))
+
+
+def migrate(params_dir, profiles_dir, name=DEFAULT_PROFILE):
+  """
+    Turns the real params directory into profile name, with params_dir a symlink to it. Called with the params lock
+    held. The profile is built from hard links, so open files and the lock keep their inodes, then the directory and
+    the symlink are exchanged in one atomic rename so readers never find params_dir missing (where supported).
+  """
+  if os.path.islink(params_dir):
+    return
+  target = os.path.join(profiles_dir, name)
+  if os.path.exists(target):
+    raise Exception('opParams: Can\'t move params into profile {}, it already exists'.format(name))
+  os.makedirs(profiles_dir, exist_ok=True)
+  tmp_dir = tempfile.mkdtemp(prefix='.' + name, dir=profiles_dir)
+  for file_name in os.listdir(params_dir):
+    os.link(os.path.join(params_dir, file_name), os.path.join(tmp_dir, file_name))
+  os.chmod(tmp_dir, 0o777)
+  os.rename(tmp_dir, target)
+
+  link = _make_link(params_dir, target)
+  if _renameat2 is not None and _renameat2(AT_FDCWD, os.fsencode(link), AT_FDCWD, os.fsencode(params_dir), RENAME_EXCHANGE) == 0:
+    shutil.rmtree(link)  # the old directory, now at the link's temporary path
+    return
+  old_dir = link + '.old'  # no atomic exchange: params_dir is missing for the instant between these renames
+  os.rename(params_dir, old_dir)
+  os.rename(link, params_dir)
+  shutil.rmtree(old_dir)
+
+
+def switch(params_dir, profiles_dir, name):  # atomically points params_dir at profile name, called with the params lock held
+  link = _make_link(params_dir, os.path.join(profiles_dir, name))
+  os.replace(link, params_dir)
+
+
+def save(profiles_dir, name, write_fn):
+  """Replaces profile name with a new directory that write_fn(path) fills, never leaving a half written profile"""
+  os.makedirs(profiles_dir, exist_ok=True)
+  tmp_dir = tempfile.mkdtemp(prefix='.' + name, dir=profiles_dir)
+  try:
+    write_fn(tmp_dir)
+    os.chmod(tmp_dir, 0o777)
+    target = os.path.join(profiles_dir, name)
+    old_dir = None
+    if os.path.exists(target):
+      old_dir = tempfile.mkdtemp(prefix='.' + name, dir=profiles_dir)
+      os.rename(target, os.path.join(old_dir, name))
+    os.rename(tmp_dir, target)
+  except BaseException:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    raise
+  if old_dir is not None:
+    shutil.rmtree(old_dir)
+
+
+def _make_link(params_dir, target):  # Returns the path of a new symlink to target, to be renamed over params_dir
+  link = os.path.join(os.path.dirname(params_dir), '.{}_link'.format(os.path.basename(params_dir)))
+  for path in (link, link + '.old'):  # left behind if a previous switch was interrupted
+    if os.path.islink(path):
+      os.remove(path)
+    elif os.path.isdir(path):
+      shutil.rmtree(path)
+  os.symlink(os.path.relpath(target, os.path.dirname(params_dir)), link)
+  return link
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import heapq
+
+BACKOFF_AFTER = 10  # unchanged refreshes in a row before a key's interval starts growing
+BACKOFF_FACTOR = 1.5
+MAX_BACKOFF = 4  # an interval never grows past this many times the key's read_frequency
+
+
+class RefreshScheduler:
+  """
+    Decides when each param is re-read from disk. Keys are scheduled once they're first used, and all keys that are
+    due are refreshed together, so a .get() only compares the time against the earliest due time.
+    A key's interval starts at its read_frequency and backs off while its value doesn't change. It snaps back on
+    the first change, and no key backs off while live tuning is active.
+  """
+  def __init__(self):
+    self.next_due = float('inf')  # earliest due time of any key
+    self.live_tuning = False
+    self._keys = {}  # key: [read_frequency, current interval, unchanged refreshes in a row, can back off]
+    self._due = {}  # key: due time of its current heap entry, older entries are skipped
+    self._heap = []
+
+  def __contains__(self, key):
+    return key in self._keys
+
+  def add(self, key, interval, due, backoff=True):
+    self._keys[key] = [interval, interval, 0, backoff]
+    self._schedule(key, due)
+
+  def expire(self, key):  # makes key due on the next check
+    if key in self._keys:
+      self._schedule(key, -float('inf'))
+
+  def pop_due(self, now):  # Returns the keys that are due, each has to be rescheduled after its refresh
+    due = []
+    while self._heap and self._heap[0][0] <= now:
+      t, key = heapq.heappop(self._heap)
+      if self._due.get(key) == t:
+        del self._due[key]
+        due.append(key)
+    self.next_due = self._heap[0][0] if self._heap else float('inf')
+    return due
+
+  def reschedule(self, key, changed, now):
+    state = self._keys[key]
+    if changed or self.live_tuning or not state[3]:
+      state[1], state[2] = state[0], 0
+    else:
+      state[2] += 1
+      if state[2] >= BACKOFF_AFTER:
+        state[1] = min(state[1] * BACKOFF_FACTOR, state[0] * MAX_BACKOFF)
+    self._schedule(key, now + state[1])
+
+  def set_live_tuning(self, live_tuning, now):
+    if live_tuning and not self.live_tuning:  # pull backed off keys in to their read_frequency
+      for key, state in self._keys.items():
+        state[2] = 0
+        if state[1] > state[0]:
+          state[1] = state[0]
+          if key in self._due:
+            self._schedule(key, min(self._due[key], now + state[0]))
+    self.live_tuning = live_tuning
+
+  def _schedule(self, key, due):
+    self._due[key] = due
+    heapq.heappush(self._heap, (due, key))
+    self.next_due = min(self.next_due, due)
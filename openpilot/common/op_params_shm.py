@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import json
+import time
+import fcntl
+import struct
+from multiprocessing import shared_memory
+
+SHM_NAME = 'op_params'
+SHM_SIZE = 1024 * 1024  # pages are only backed once touched, so this is cheap
+MAGIC = b'OPSM'
+_HEADER = struct.Struct('<4sQI')  # magic, sequence (odd while a write is in progress), payload length
+_SEQUENCE = struct.Struct('<Q')
+_SEQUENCE_OFFSET = 4
+READ_RETRIES = 100
+
+
+def _open_segment(name, size):
+  try:
+    try:
+      shm = shared_memory.SharedMemory(name, create=True, size=size, track=False)
+    except TypeError:  # track was added in python 3.13
+      shm = shared_memory.SharedMemory(name, create=True, size=size)
+      _untrack(shm)
+    return shm, True
+  except FileExistsError:
+    pass
+  try:
+    shm = shared_memory.SharedMemory(name, track=False)
+  except TypeError:
+    shm = shared_memory.SharedMemory(name)
+    _untrack(shm)
+  return shm, False
+
+
+def _untrack(shm):  # the segment must outlive whichever process happened to create it
+  try:
+    from multiprocessing import resource_tracker
+    resource_tracker.unregister(shm._name, 'shared_memory')  # pylint: disable=protected-access
+  except Exception:
+    pass
+
+
+class SharedParams:
+  """
+    A snapshot of all params in a shared memory segment, guarded by a seqlock. Any number of processes
+    can read it without touching the filesystem, and readers tell if anything changed by comparing
+    the sequence number. Writers serialize on a file lock and merge their changes into the snapshot.
+  """
+  def __init__(self, lock_path, name=SHM_NAME, size=SHM_SIZE):
+    self.lock_path = lock_path
+    self._shm, self.created = _open_segment(name, size)
+    self._buf = self._shm.buf
+
+  def sequence(self):  # 0 if nothing was published yet
+    return _SEQUENCE.unpack_from(self._buf, _SEQUENCE_OFFSET)[0]
+
+  def snapshot(self, last_sequence=None):  # Returns sequence, params or None if unchanged since last_sequence
+    for _ in range(READ_RETRIES):
+      magic, seq, length = _HEADER.unpack_from(self._buf, 0)
+      if seq == last_sequence:
+        return None
+      if seq & 1 or magic != MAGIC:  # writer in progress (or first publish not done yet)
+        if seq == 0:
+          return None
+        time.sleep(0)
+        continue
+      data = bytes(self._buf[_HEADER.size:_HEADER.size + length])
+      if self.sequence() != seq:
+        continue
+      try:
+        return seq, json.loads(data)
+      except json.decoder.JSONDecodeError:  # torn read that the sequence check missed, try again
+        continue
+    return None
+
+  def publish(self, changes, replace=False):  # merges changes into the snapshot, or replaces it entirely. Returns its sequence
+    with open(self.lock_path, 'a') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      params = {}
+      if not replace:
+        current = self.snapshot()
+        if current is not None:
+          params = current[1]
+      params.update(changes)
+
+      payload = json.dumps(params, sort_keys=True).encode()  # sorted, so the same params are always the same bytes
+      if _HEADER.size + len(payload) > len(self._buf):
+        raise ValueError('opParams: params are too large for the shared memory segment ({} bytes)'.format(len(payload)))
+      seq = self.sequence()
+      magic, _, length = _HEADER.unpack_from(self._buf, 0)
+      if magic == MAGIC and seq & 1 == 0 and self._buf[_HEADER.size:_HEADER.size + length] == payload:
+        return seq  # unchanged, so readers aren't made to reload it (the sync daemon republishes every second)
+      seq += 2 if seq & 1 == 0 else 1  # recover from a writer that died mid-write
+      _SEQUENCE.pack_into(self._buf, _SEQUENCE_OFFSET, seq - 1)
+      self._buf[_HEADER.size:_HEADER.size + len(payload)] = payload
+      _HEADER.pack_into(self._buf, 0, MAGIC, seq, len(payload))
+    return seq
+
+  def close(self):
+    self._buf = None
+    self._shm.close()
+
+
+def main(interval=1.):
+  """
+    Sync daemon: publishes the param files to shared memory so edits made outside of opParams.put
+    (by hand, or by an opParams without shared=True) still reach shared readers.
+  """
+  from common.op_params import opParams
+  op_params = opParams(shared=True)
+  while True:
+    op_params.sync_shared()
+    time.sleep(interval)
+
+
+if __name__ == '__main__':
+  main()
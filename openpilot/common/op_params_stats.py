@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import atexit
+import threading
+
+HISTOGRAM_BUCKETS = 24  # log2 microsecond buckets, the last one also counts anything slower (> 8 seconds)
+
+
+class KeyStats:
+  __slots__ = ('gets', 'refreshes', 'unchanged', 'reads', 'decode_ns', 'decode_bytes', 'puts', 'writes', 'write_ns', 'write_histogram')
+
+  def __init__(self):
+    self.gets = self.refreshes = self.unchanged = self.reads = self.decode_ns = self.decode_bytes = 0
+    self.puts = self.writes = self.write_ns = 0
+    self.write_histogram = [0] * HISTOGRAM_BUCKETS
+
+  def to_dict(self):
+    return {
+      'gets': self.gets,
+      'refreshes': self.refreshes,
+      'refresh_hits': self.unchanged,  # refreshes that found the value unchanged
+      'refresh_misses': self.refreshes - self.unchanged,
+      'reads': self.reads,  # files actually read and decoded
+      'decode_ns_mean': self.decode_ns / self.reads if self.reads else None,
+      'decode_bytes': self.decode_bytes,
+      'puts': self.puts,
+      'writes': self.writes,
+      'write_ns_mean': self.write_ns / self.writes if self.writes else None,
+      # upper bound in microseconds: number of writes
+      'write_us_histogram': {str(2 ** i): n for i, n in enumerate(self.write_histogram) if n},
+    }
+
+
+class ParamsStats:
+  """
+    Per-key counters and timings for one process, collected while enabled with common.op_params.enable_stats()
+    (or by setting OP_PARAMS_STATS=/path/to/dump.json). When disabled, the only cost is a None check per call.
+  """
+  def __init__(self):
+    self.started = time.time()
+    self._keys = {}
+    self._dumper = None
+
+  def key(self, key):
+    stats = self._keys.get(key)
+    if stats is None:
+      stats = self._keys[key] = KeyStats()
+    return stats
+
+  def refreshed(self, key, changed):
+    stats = self.key(key)
+    stats.refreshes += 1
+    if not changed:
+      stats.unchanged += 1
+
+  def decoded(self, key, ns, size):
+    stats = self.key(key)
+    stats.reads += 1
+    stats.decode_ns += ns
+    stats.decode_bytes += size
+
+  def written(self, key, ns):
+    stats = self.key(key)
+    stats.writes += 1
+    stats.write_ns += ns
+    stats.write_histogram[min((ns // 1000).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+  def snapshot(self):  # Returns everything collected so far as a json-able dict
+    return {'pid': os.getpid(), 'started': self.started, 'time': time.time(),
+            'keys': {key: stats.to_dict() for key, stats in sorted(self._keys.copy().items())}}
+
+  def dump(self, path):
+    from atomicwrites import atomic_write
+    with atomic_write(path, overwrite=True) as f:
+      json.dump(self.snapshot(), f, indent=2)
+
+  def start_dumping(self, path, interval):  # dumps to path every interval seconds, and at exit
+    self.stop_dumping()
+    stop = threading.Event()
+
+    def run():
+      while not stop.wait(interval):
+        self.dump(path)
+    self._dumper = (stop, path)
+    threading.Thread(target=run, name='opParamsStats', daemon=True).start()
+    atexit.register(self.dump, path)
+
+  def stop_dumping(self):
+    if self._dumper is not None:
+      stop, path = self._dumper
+      stop.set()
+      atexit.unregister(self.dump)
+      self._dumper = None
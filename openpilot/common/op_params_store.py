@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import os
+import json
+import mmap
+import fcntl
+import struct
+
+MAGIC = b'OPPK'
+FORMAT_VERSION = 1
+# magic, format version, flags, generation, data offset, data length, region capacity, region base
+_HEADER = struct.Struct('<4sHHQQIIQ')
+_GENERATION = struct.Struct('<Q')
+_GENERATION_OFFSET = 8
+_COUNT = struct.Struct('<I')
+_ENTRY = struct.Struct('<HII')  # key length, value offset, value length (key bytes follow)
+HEADER_SIZE = 64  # header is padded so data regions start aligned
+MIN_CAPACITY = 4096
+READ_RETRIES = 100
+
+
+def _encode_payload(raw):  # Returns the payload for {key: json bytes}, and its index
+  keys = [k.encode() for k in raw]
+  values = list(raw.values())
+  offset = _COUNT.size + _ENTRY.size * len(keys) + sum(map(len, keys))
+
+  entries, index, pack = [_COUNT.pack(len(keys))], {}, _ENTRY.pack
+  for key, k, v in zip(raw, keys, values):
+    entries.append(pack(len(k), offset, len(v)))
+    entries.append(k)
+    index[key] = (offset, len(v))
+    offset += len(v)
+  return b''.join(entries + values), index
+
+
+def _splice(data, index, changes, delete):
+  """
+    Returns the payload with changes ({key: json bytes}) applied and delete removed, and its index. Unchanged values
+    are copied as the bytes they're stored as, and if no value changes length the old payload is patched in place.
+  """
+  if not delete and all(key in index and index[key][1] == len(value) for key, value in changes.items()):
+    payload = bytearray(data)
+    for key, value in changes.items():
+      offset, length = index[key]
+      payload[offset:offset + length] = value
+    return bytes(payload), index
+  raw = {key: data[offset:offset + length] for key, (offset, length) in index.items()}
+  raw.update(changes)
+  for key in delete:
+    raw.pop(key, None)
+  return _encode_payload(raw)
+
+
+def _decode_index(data):
+  index, pos = {}, _COUNT.size
+  for _ in range(_COUNT.unpack_from(data, 0)[0]):
+    key_len, offset, length = _ENTRY.unpack_from(data, pos)
+    pos += _ENTRY.size
+    index[data[pos:pos + key_len].decode()] = (offset, length)
+    pos += key_len
+  return index
+
+
+class PackedStore:
+  """
+    All params packed into one file and read through mmap. Writers put the new payload into whichever of two
+    data regions isn't active, fsync, then flip the fixed-size header to point at it, so readers only ever see
+    complete snapshots and a crashed write leaves the previous one intact. The header's generation counter is
+    bumped on every write, so a reader can tell nothing changed with one integer compare.
+  """
+  def __init__(self, path):
+    self.path = path
+    self._mm = None
+    self._ino = None  # of the file the mapping and the cached snapshot are from
+    self._index = None
+    self._index_gen = -1
+    self._data = b''
+
+  def exists(self):
+    return os.path.exists(self.path)
+
+  def generation(self):  # 0 if the store hasn't been written yet
+    if self._mm is None and not self._map():
+      return 0
+    return _GENERATION.unpack_from(self._mm, _GENERATION_OFFSET)[0]
+
+  def read(self, key):  # Returns None, False if key is missing or a json error occurs
+    if not self._snapshot() or key not in self._index:
+      return None, False
+    offset, length = self._index[key]
+    try:
+      return json.loads(self._data[offset:offset + length]), True
+    except json.decoder.JSONDecodeError:
+      return None, False
+
+  def __contains__(self, key):  # True even if the stored value can't be decoded
+    return self._snapshot() and key in self._index
+
+  def read_all(self):
+    if not self._snapshot():
+      return {}
+    params = {}
+    for key in self._index:
+      value, success = self.read(key)
+      if success:
+        params[key] = value
+    return params
+
+  def write(self, key, value):
+    self.update({key: value})
+
+  def delete(self, key):
+    self.update({}, delete=[key])
+
+  def update(self, changes, delete=()):  # applies all changes in one atomic write
+    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)  # serialize writers across processes, released on close
+      ino = os.fstat(fd).st_ino
+      if ino != self._ino:  # replaced since we mapped it or cached our last write
+        self._unmap()
+      changes = {key: json.dumps(value).encode() for key, value in changes.items()}
+      data, index = (self._data, self._index) if self._snapshot() else (b'', {})  # current now that we hold the lock
+      payload, index = _splice(data, index, changes, delete)
+      gen = self._write_locked(fd, payload)
+      self._data, self._index, self._index_gen, self._ino = payload, index, gen, ino  # so our next write doesn't decode the index again
+    finally:
+      os.close(fd)
+    os.chmod(self.path, 0o666)
+
+  def _write_locked(self, fd, payload):  # Returns the new generation
+    size = os.fstat(fd).st_size
+    if size >= HEADER_SIZE:
+      _, _, _, gen, active, _, capacity, base = _HEADER.unpack(os.pread(fd, _HEADER.size, 0))
+    else:
+      gen, active, capacity, base = 0, 0, 0, HEADER_SIZE
+
+    if len(payload) > capacity:  # grow: start a fresh pair of regions at the end of the file
+      base = max(size, base + 2 * capacity, HEADER_SIZE)
+      capacity = max(MIN_CAPACITY, 1 << (2 * len(payload) - 1).bit_length())
+      target = base
+    else:
+      target = base + capacity if active == base else base
+
+    os.pwrite(fd, payload, target)
+    if os.fstat(fd).st_size < base + 2 * capacity:  # file never shrinks, so mapped readers never fault
+      os.ftruncate(fd, base + 2 * capacity)
+    os.fsync(fd)
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, 0, gen + 1, target, len(payload), capacity, base)
+    os.pwrite(fd, header, 0)
+    os.fsync(fd)
+    return gen + 1
+
+  def _map(self):
+    try:
+      with open(self.path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < HEADER_SIZE:
+          return False
+        self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        ino = os.fstat(f.fileno()).st_ino
+        if ino != self._ino:  # a generation of another file says nothing about our cached snapshot
+          self._index_gen = -1
+          self._ino = ino
+    except FileNotFoundError:
+      return False
+    return True
+
+  def _unmap(self):
+    if self._mm is not None:
+      self._mm.close()
+      self._mm = None
+    self._index_gen = -1
+
+  def _snapshot(self):  # makes sure self._data and self._index are for the current generation
+    for _ in range(READ_RETRIES):
+      if self._mm is None and not self._map():
+        return False
+      header = _HEADER.unpack_from(self._mm, 0)
+      magic, version, _, gen, offset, length, _, _ = header
+      if magic != MAGIC or version != FORMAT_VERSION:
+        return False
+      if gen == self._index_gen:
+        return True
+      if offset + length > len(self._mm):  # file grew since we mapped it
+        self._unmap()
+        continue
+      data = self._mm[offset:offset + length]
+      if _HEADER.unpack_from(self._mm, 0) == header:  # no writer flipped the header meanwhile
+        self._data, self._index, self._index_gen = data, _decode_index(data), gen
+        return True
+    return False
+
+  def migrate_from_dir(self, params_dir, decode=json.loads):  # packs the one-file-per-key directory, like _import_params does for op_params.json
+    params = {}
+    for key in os.listdir(params_dir):
+      if key.startswith('.'):
+        continue
+      try:
+        with open(os.path.join(params_dir, key), 'rb') as f:
+          params[key] = decode(f.read())
+      except (OSError, ValueError):  # JSONDecodeError is a ValueError
+        pass
+    self.update(params)
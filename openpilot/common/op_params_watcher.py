@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import os
+import sys
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008  # file opened for writing was closed (edited in place)
+IN_MOVED_TO = 0x00000080  # file renamed into the directory (atomic_write)
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000  # the kernel dropped events, so any file may have changed
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def _load_libc():
+  if not sys.platform.startswith('linux'):
+    return None
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+  except (OSError, AttributeError):  # no libc or libc without inotify
+    return None
+
+
+_libc = _load_libc()
+
+
+def inotify_available():
+  return _libc is not None
+
+
+class ParamsWatcher(threading.Thread):
+  """
+    Watches a directory with inotify and calls callback(names) from a background thread with the files in it that were
+    rewritten, once per batch of events. Dotfiles (atomic_write temp files, markers) are ignored.
+    If the path is a symlink (the active profile) and it's replaced, the new target is watched and callback(None) is called.
+    callback(None) is also called when a file named in reload_on is written, dotfiles included, and when events were lost.
+    If the thread dies, on_exit(watcher) is called so the owner can fall back to polling.
+  """
+  def __init__(self, path, callback, reload_on=(), on_exit=None):
+    super().__init__(name='opParamsWatcher', daemon=True)
+    if _libc is None:
+      raise OSError('inotify is not available on this platform')
+    self.path = path
+    self.callback = callback
+    self.reload_on = set(reload_on)
+    self.on_exit = on_exit
+    self._fd = _libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+    if self._fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    try:
+      self._wd = self._add_watch(path, WATCH_MASK)
+      self._parent_wd = self._add_watch(os.path.dirname(path), IN_MOVED_TO | IN_CREATE)
+    except OSError:
+      os.close(self._fd)
+      raise
+    self._wake_r, self._wake_w = os.pipe()  # used to break out of poll() on stop()
+    self._running = True
+
+  def run(self):
+    poller = select.poll()
+    poller.register(self._fd, select.POLLIN)
+    poller.register(self._wake_r, select.POLLIN)
+    try:
+      while self._running:
+        for fd, _ in poller.poll():
+          if fd == self._wake_r:
+            return
+          names = self._read_events()
+          if not names:
+            continue
+          try:
+            self.callback(None if None in names else names)
+          except Exception:  # never let a bad file kill the watcher
+            pass
+    finally:
+      for fd in (self._fd, self._wake_r, self._wake_w):
+        os.close(fd)
+      if self._running and self.on_exit is not None:  # not stopped, so it died
+        self.on_exit(self)
+
+  def pending(self, names):  # Returns names with the events that arrived since, None if they need a full reload. Call from callback
+    more = self._read_events()
+    if None in more:
+      return None
+    return names + [name for name in more if name not in names]
+
+  def stop(self):
+    self._running = False
+    os.write(self._wake_w, b'\0')
+
+  def _add_watch(self, path, mask):
+    wd = _libc.inotify_add_watch(self._fd, os.fsencode(path), mask)  # follows symlinks
+    if wd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+    return wd
+
+  def _rewatch(self):  # the symlink now points at another directory
+    _libc.inotify_rm_watch(self._fd, self._wd)
+    try:
+      self._wd = self._add_watch(self.path, WATCH_MASK)
+    except OSError:  # gone for an instant while being replaced, the rename that follows retries
+      self._wd = -1
+
+  def _read_events(self):
+    try:
+      buf = os.read(self._fd, 64 * 1024)
+    except BlockingIOError:
+      return []
+    names, offset = [], 0
+    base_name = os.path.basename(self.path)
+    while offset + _EVENT.size <= len(buf):
+      wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+      offset += _EVENT.size
+      name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))  # any bytes, like every other path in the directory
+      offset += length
+      if mask & IN_Q_OVERFLOW:
+        names = [None]
+      elif wd == self._parent_wd:
+        if name == base_name:
+          self._rewatch()
+          names = [None]  # everything is reloaded anyway
+      elif wd == self._wd and name in self.reload_on and mask & WATCH_MASK:
+        names = [None]
+      elif wd == self._wd and name and not name.startswith('.') and mask & WATCH_MASK and name not in names and None not in names:
+        names.append(name)  # coalesce repeated events for the same file in one read
+    return names
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import atexit
+import threading
+
+
+class WriteBehindQueue:
+  """
+    Collects param writes and hands them to flush_fn(dict) from a background thread. Writes to the same key
+    are coalesced, so only the newest value is written. A batch is flushed interval seconds after its first
+    write, whenever flush() is called, and at interpreter exit.
+  """
+  def __init__(self, flush_fn, interval, on_error=None):
+    self.interval = interval
+    self._flush_fn = flush_fn
+    self._on_error = on_error
+    self._pending = {}
+    self._inflight = {}  # batch being written right now
+    self._cond = threading.Condition()
+    self._flush_lock = threading.Lock()  # one flush at a time, so batches are written in order
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run, name='opParamsWriter', daemon=True)
+    self._thread.start()
+    atexit.register(self.close)
+
+  def put(self, params):  # all keys in one call are flushed together
+    with self._cond:
+      self._pending.update(params)
+      self._cond.notify()
+
+  def is_pending(self, key):  # True until the key's newest value is on disk
+    return key in self._pending or key in self._inflight
+
+  def flush(self):  # synchronously writes everything queued so far
+    with self._flush_lock:
+      with self._cond:
+        batch, self._pending = self._pending, {}
+        self._inflight = batch
+      if not batch:
+        return
+      try:
+        self._flush_fn(batch)
+      except Exception as e:
+        with self._cond:  # keep the batch for the next flush, newer puts win
+          batch.update(self._pending)
+          self._pending = batch
+        if self._on_error is None:
+          raise
+        self._on_error(e)
+      finally:
+        self._inflight = {}
+
+  def close(self):  # stops the thread after a final flush
+    if not self._stop.is_set():
+      self._stop.set()
+      with self._cond:
+        self._cond.notify()
+      self._thread.join()
+    self.flush()
+
+  def _run(self):
+    while not self._stop.is_set():
+      with self._cond:
+        while not self._pending and not self._stop.is_set():
+          self._cond.wait()
+      self._stop.wait(self.interval)  # let more writes coalesce, returns early on close
+      try:
+        self.flush()
+      except Exception:  # already reported through on_error, retried next time
+        pass
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+
+import common.op_params_journal as op_params_journal
+from common.op_params_journal import Journal, PENDING, DONE
+
+
+class TestOpParamsJournal(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, 'params.journal')
+    self.stored = {'camera_offset': 0.06, 'a_toggle_param': False}
+    self.redone = []
+    self.journal = Journal(self.path, self._redo)
+    self.journal.create(dict(self.stored), t=0)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _redo(self, params, removed):
+    self.redone.append((params, removed))
+    self.stored.update(params)
+    for key in removed:
+      self.stored.pop(key, None)
+
+  def _lines(self):
+    with open(self.path, 'rb') as f:
+      return f.read().splitlines(keepends=True)
+
+  def test_done_record_not_redone(self):
+    offset = self.journal.append({'camera_offset': [0.06, 0.1]}, 'put', t=1)
+    self.journal.done(offset)
+    self.assertEqual(self.journal.recover(), [])
+    self.assertEqual(self.redone, [])
+    self.assertEqual(self._lines()[-1][:1], DONE)
+
+  def test_pending_record_recovered(self):  # crashed after journaling, before (or while) writing the files
+    self.journal.append({'camera_offset': [0.06, 0.1], 'a_toggle_param': [False, True]}, 'put', t=1)
+    self.assertEqual(self._lines()[-1][:1], PENDING)
+
+    self.assertEqual(sorted(Journal(self.path, self._redo).recover()), ['a_toggle_param', 'camera_offset'])
+    self.assertEqual(self.redone, [({'camera_offset': 0.1, 'a_toggle_param': True}, [])])
+    self.assertEqual(self.stored, {'camera_offset': 0.1, 'a_toggle_param': True})
+    self.assertEqual(self._lines()[-1][:1], DONE)
+    self.assertEqual(self.journal.recover(), [])  # only redone once
+    self.assertEqual(len(self.redone), 1)
+
+  def test_pending_delete_recovered(self):
+    self.journal.append({'a_toggle_param': [False, None]}, 'delete', t=1)
+    self.assertEqual(self.journal.recover(), ['a_toggle_param'])
+    self.assertEqual(self.redone, [({}, ['a_toggle_param'])])
+    self.assertNotIn('a_toggle_param', self.stored)
+
+  def test_append_recovers_pending_first(self):
+    self.journal.append({'camera_offset': [0.06, 0.1]}, 'put', t=1)
+    self.journal.done(self.journal.append({'camera_offset': [0.1, 0.2]}, 'put', t=2))
+    self.assertEqual(self.redone, [({'camera_offset': 0.1}, [])])
+    self.assertEqual([line[:1] for line in self._lines()[1:]], [DONE, DONE])
+
+  def test_torn_tail_truncated(self):  # crashed while appending, before any param file was touched
+    self.journal.done(self.journal.append({'camera_offset': [0.06, 0.1]}, 'put', t=1))
+    intact = os.path.getsize(self.path)
+    with open(self.path, 'ab') as f:
+      f.write(PENDING + b'{"t": 2, "src": "put", "c": {"camera_off')
+
+    self.assertEqual(len(list(self.journal.records())), 2)  # readers stop before the torn record
+    self.assertEqual(self.journal.recover(), [])
+    self.assertEqual(self.redone, [])
+    self.assertEqual(os.path.getsize(self.path), intact)
+    self.assertEqual(self.journal.state_at(3), {'camera_offset': 0.1, 'a_toggle_param': False})
+
+  def test_torn_tail_after_pending(self):  # a pending record is only ever the last complete one
+    self.journal.append({'camera_offset': [0.06, 0.1]}, 'put', t=1)
+    with open(self.path, 'ab') as f:
+      f.write(PENDING + b'{"t": 2')
+    self.assertEqual(self.journal.recover(), ['camera_offset'])
+    self.assertEqual(self.stored['camera_offset'], 0.1)
+    self.assertTrue(self._lines()[-1].endswith(b'\n'))
+
+  def test_state_at_and_history(self):
+    self.journal.done(self.journal.append({'camera_offset': [0.06, 0.1]}, 'put', t=1))
+    self.journal.done(self.journal.append({'camera_offset': [0.1, 0.2], 'a_toggle_param': [False, True]}, 'put', t=2))
+    self.assertIsNone(self.journal.state_at(-1))
+    self.assertEqual(self.journal.state_at(0), {'camera_offset': 0.06, 'a_toggle_param': False})
+    self.assertEqual(self.journal.state_at(1.5), {'camera_offset': 0.1, 'a_toggle_param': False})
+    self.assertEqual(self.journal.state_at(2), {'camera_offset': 0.2, 'a_toggle_param': True})
+    self.assertEqual(self.journal.history(since=2), [(2, 'put', 'camera_offset', 0.1, 0.2), (2, 'put', 'a_toggle_param', False, True)])
+    self.assertEqual(self.journal.history(until=1), [(1, 'put', 'camera_offset', 0.06, 0.1)])
+
+  def test_compact_before(self):
+    for t in range(1, 6):
+      self.journal.done(self.journal.append({'camera_offset': [t / 10, (t + 1) / 10]}, 'put', t=t))
+    size = os.path.getsize(self.path)
+    self.journal.compact(before=4)
+
+    self.assertLess(os.path.getsize(self.path), size)
+    self.assertIsNone(self.journal.state_at(2))  # folded into the checkpoint
+    self.assertEqual(self.journal.state_at(3), {'camera_offset': 0.4, 'a_toggle_param': False})
+    self.assertEqual(self.journal.state_at(5), {'camera_offset': 0.6, 'a_toggle_param': False})
+    self.assertEqual([entry[0] for entry in self.journal.history()], [4, 5])
+
+  def test_compact_redoes_pending_first(self):
+    self.journal.append({'camera_offset': [0.06, 0.1]}, 'put', t=1)
+    self.journal.compact(before=2)
+    self.assertEqual(self.redone, [({'camera_offset': 0.1}, [])])
+    self.assertEqual(self.journal.state_at(1), {'camera_offset': 0.1, 'a_toggle_param': False})
+    self.assertEqual(len(self._lines()), 1)
+
+  def test_maybe_compact_size(self):
+    max_bytes = op_params_journal.MAX_BYTES
+    op_params_journal.MAX_BYTES = 2048
+    try:
+      for t in range(1, 100):
+        self.journal.done(self.journal.append({'camera_offset': [t - 1, t]}, 'put', t=t))
+        self.journal.maybe_compact()
+    finally:
+      op_params_journal.MAX_BYTES = max_bytes
+    self.assertLessEqual(os.path.getsize(self.path), 2048)
+    self.assertEqual(self.journal.state_at(99)['camera_offset'], 99)
+    self.assertIsNone(self.journal.state_at(1))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+
+from common.op_params_store import PackedStore, HEADER_SIZE, MIN_CAPACITY, _HEADER
+
+
+class TestOpParamsStore(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, '.packed')
+    self.store = PackedStore(self.path)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _header(self):
+    with open(self.path, 'rb') as f:
+      return _HEADER.unpack(f.read(_HEADER.size))
+
+  def test_round_trip(self):
+    params = {'camera_offset': 0.06, 'a_toggle_param': True, 'username': 'sshane', 'table': [[0., 20.], [15., 14.5]],
+              'none': None, 'nan': float('nan')}
+    self.assertEqual(self.store.generation(), 0)
+    self.store.update(params)
+    self.assertEqual(self.store.generation(), 1)
+
+    for store in (self.store, PackedStore(self.path)):  # our cached snapshot and a fresh reader
+      values = store.read_all()
+      self.assertEqual(values.keys(), params.keys())
+      self.assertNotEqual(values['nan'], values['nan'])
+      del values['nan']
+      self.assertEqual(values, {k: v for k, v in params.items() if k != 'nan'})
+      self.assertEqual(store.read('missing'), (None, False))
+
+  def test_update_and_delete(self):
+    self.store.update({'a': 1.5, 'b': 'two', 'c': [3]})
+    reader = PackedStore(self.path)
+    self.assertEqual(reader.read('b'), ('two', True))
+
+    self.store.update({'a': 2.5})  # same length, patched in place
+    self.assertEqual(reader.read_all(), {'a': 2.5, 'b': 'two', 'c': [3]})
+    self.store.update({'b': 'a longer value', 'd': False}, delete=['c'])
+    self.assertEqual(reader.read_all(), {'a': 2.5, 'b': 'a longer value', 'd': False})
+    self.assertNotIn('c', reader)
+    self.assertEqual(reader.generation(), 3)
+
+    PackedStore(self.path).update({'a': 0.})  # another writer, our cached index is stale now
+    self.store.update({'d': True})
+    self.assertEqual(PackedStore(self.path).read_all(), {'a': 0., 'b': 'a longer value', 'd': True})
+
+  def test_flip_between_regions(self):
+    self.store.update({'a': 1})
+    _, _, _, gen, first, _, capacity, base = self._header()
+    self.assertEqual((first, base), (HEADER_SIZE, HEADER_SIZE))
+    self.store.update({'a': 2})
+    second = self._header()[4]
+    self.assertEqual(second, base + capacity)  # written to the inactive region
+    self.store.update({'a': 3})
+    self.assertEqual(self._header()[4], first)
+    self.assertEqual(PackedStore(self.path).read('a'), (3, True))
+
+  def test_grow(self):
+    reader = PackedStore(self.path)
+    self.store.update({'small': 1})
+    self.assertEqual(reader.read('small'), (1, True))  # maps the small file
+    capacity = self._header()[6]
+    self.assertEqual(capacity, MIN_CAPACITY)
+
+    big = [float(i) for i in range(2000)]
+    self.store.update({'big': big})
+    _, _, _, _, offset, length, new_capacity, base = self._header()
+    self.assertGreater(new_capacity, capacity)
+    self.assertGreaterEqual(base, HEADER_SIZE + 2 * capacity)  # old regions are left alone for readers mapped to them
+    self.assertEqual(os.path.getsize(self.path), base + 2 * new_capacity)
+    self.assertEqual(reader.read_all(), {'small': 1, 'big': big})  # the reader remaps the grown file
+
+  def test_interrupted_write_keeps_snapshot(self):  # crashed after writing the payload, before flipping the header
+    self.store.update({'a': 1, 'b': 2})
+    _, _, _, gen, active, _, capacity, base = self._header()
+    inactive = base + capacity if active == base else base
+    with open(self.path, 'r+b') as f:
+      f.seek(inactive)
+      f.write(b'\xff' * 64)
+    reader = PackedStore(self.path)
+    self.assertEqual(reader.generation(), gen)
+    self.assertEqual(reader.read_all(), {'a': 1, 'b': 2})
+
+    self.store.update({'b': 3})  # the next write overwrites the half written region
+    self.assertEqual(reader.read_all(), {'a': 1, 'b': 3})
+
+  def test_replaced_file(self):
+    self.store.update({'a': 1})
+    other = PackedStore(self.path + '.new')
+    other.update({'a': 2, 'b': 3})
+    os.replace(other.path, self.path)
+    self.store.update({'c': 4})  # must not write over the old inode's cached snapshot
+    self.assertEqual(PackedStore(self.path).read_all(), {'a': 2, 'b': 3, 'c': 4})
+
+  def test_migrate_from_dir(self):
+    params_dir = os.path.join(self.tmp, 'params')
+    os.mkdir(params_dir)
+    for key, data in (('a', b'1.5'), ('b', b'"x"'), ('bad', b'{'), ('.lock', b'')):
+      with open(os.path.join(params_dir, key), 'wb') as f:
+        f.write(data)
+    self.store.migrate_from_dir(params_dir)
+    self.assertEqual(PackedStore(self.path).read_all(), {'a': 1.5, 'b': 'x'})
+
+
+if __name__ == "__main__":
+  unittest.main()
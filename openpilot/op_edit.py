@@ -1,16 +1,76 @@
 #!/usr/bin/env python3
-import time
-from common.op_params import opParams
+"""
+  Interactive editor: python op_edit.py
+  Scripted tuning, with exit code 0 on success, 1 if diff found differences and 2 for invalid input:
+    python op_edit.py get camera_offset a_toggle_param
+    python op_edit.py set camera_offset=0.1 a_toggle_param=true  # values are json, anything else is a string
+    python op_edit.py dump > tune.json
+    python op_edit.py load tune.json  # or - (the default) for stdin
+    python op_edit.py diff tune.json
+  set and load validate every value before writing any, then write them all in one batch.
+"""
+import sys
 import ast
+import json
+import bisect
 import difflib
+import argparse
+from common.op_params import opParams
+from common.op_params_scheduler import MAX_BACKOFF
 from common.colors import COLORS
 
+EXIT_OK, EXIT_DIFFERENT, EXIT_INVALID = 0, 1, 2
+
+
+class NameIndex:
+  """
+    Finds a param from part of its name without comparing the query to every name: prefixes by bisecting the sorted
+    names, anything else by the trigrams it shares with each name (so typos and middle parts of names still match).
+  """
+  min_score = 0.3  # fraction of the query's trigrams a name needs to be considered a match
+
+  def __init__(self, names):
+    self._names = {}  # lowercase name: name
+    self._sizes = {}  # lowercase name: number of trigrams
+    self._trigrams = {}  # trigram: lowercase names containing it
+    for name in names:
+      lower = name.lower()
+      trigrams = self._split(lower)
+      self._names[lower] = name
+      self._sizes[lower] = len(trigrams)
+      for trigram in trigrams:
+        self._trigrams.setdefault(trigram, []).append(lower)
+    self._sorted = sorted(self._names)
+
+  @staticmethod
+  def _split(s):  # padded so a name's first letters count more, like a prefix
+    s = '  {} '.format(s)
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+  def find(self, query):  # Returns the name best matching query, or None
+    query = query.lower()
+    if query in self._names:
+      return self._names[query]
+    idx = bisect.bisect_left(self._sorted, query)
+    if idx < len(self._sorted) and self._sorted[idx].startswith(query):  # shortest name with this prefix
+      return self._names[min(self._sorted[idx:bisect.bisect_right(self._sorted, query + '\uffff')], key=len)]
+
+    trigrams = self._split(query)
+    common = {}
+    for trigram in trigrams:
+      for name in self._trigrams.get(trigram, ()):
+        common[name] = common.get(name, 0) + 1
+    if not common:
+      return None
+    # most of the query found in the name first, then the name with the fewest other trigrams (dice coefficient)
+    found, _, name = max((n / len(trigrams), 2 * n / (len(trigrams) + self._sizes[name]), name) for name, n in common.items())
+    return self._names[name] if found >= self.min_score else None
+
 
 class opEdit:  # use by running `python /data/openpilot/op_edit.py`
   def __init__(self):
-    self.op_params = opParams()
+    self.op_params = opParams(watch=True)  # keeps values up to date as files change, redraws never read every file
     self.params = None
-    self.sleep_time = 0.5
     self.live_tuning = self.op_params.get('op_edit_live_mode')
     self.username = self.op_params.get('username')
     self.type_colors = {int: COLORS.BASE(179), float: COLORS.BASE(179),
@@ -19,12 +79,17 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
                         str: COLORS.BASE(77)}
 
     self.last_choice = None
+    self.name_index = None
+    self._view = None  # keys shown, rebuilt when switching between all and live params
+    self._lines = {}  # key: its rendered 'name: value' part of the listing
+    self._drawn_version = self.op_params.version()
+    self._listing = None  # ((version, live_tuning, last_choice), the whole listing) of the last redraw
 
     self.run_init()
 
   def run_init(self):
     if self.username is None:
-      self.success('\nWelcome to the {}opParams{} command line editor!'.format(COLORS.CYAN, COLORS.SUCCESS), sleep_time=0)
+      self.success('\nWelcome to the {}opParams{} command line editor!'.format(COLORS.CYAN, COLORS.SUCCESS))
       self.prompt('Would you like to add your Discord username for easier crash debugging for the fork owner?')
       self.prompt('Your username is only used for reaching out if a crash occurs.')
 
@@ -37,58 +102,29 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
         self.op_params.put('username', username)
         self.username = username
         self.success('Thanks! Saved your username\n'
-                     'Edit the \'username\' parameter at any time to update', sleep_time=1.5)
+                     'Edit the \'username\' parameter at any time to update')
       elif username_choice == 2:
         self.op_params.put('username', False)
         self.info('Got it, bringing you into opEdit\n'
-                  'Edit the \'username\' parameter at any time to update', sleep_time=1.0)
+                  'Edit the \'username\' parameter at any time to update')
     else:
-      self.success('\nWelcome to the {}opParams{} command line editor, {}!'.format(COLORS.CYAN, COLORS.SUCCESS, self.username), sleep_time=0)
+      self.success('\nWelcome to the {}opParams{} command line editor, {}!'.format(COLORS.CYAN, COLORS.SUCCESS, self.username))
 
     self.run_loop()
 
   def run_loop(self):
     while True:
       if not self.live_tuning:
-        self.info('Here are all your parameters:', sleep_time=0)
-        self.info('(non-static params update while driving)', end='\n', sleep_time=0)
+        self.info('Here are all your parameters:')
+        self.info('(non-static params update while driving)', end='\n')
       else:
-        self.info('Here are your live parameters:', sleep_time=0)
-        self.info('(changes take effect within a second)', end='\n', sleep_time=0)
-      self.params = self.op_params.get(force_update=True)
-      if self.live_tuning:  # only display live tunable params
-        self.params = {k: v for k, v in self.params.items() if self.op_params.fork_params[k].live}
-
-      values_list = []
-      for k, v in self.params.items():
-        if len(str(v)) < 20:
-          v = self.color_from_type(v)
-        else:
-          v = '{} ... {}'.format(str(v)[:30], str(v)[-15:])
-        values_list.append(v)
-
-      static = [COLORS.INFO + '(static)' + COLORS.ENDC if self.op_params.fork_params[k].static else '' for k in self.params]
-
-      to_print = []
-      blue_gradient = [33, 39, 45, 51, 87]
-      for idx, param in enumerate(self.params):
-        line = '{}. {}: {}  {}'.format(idx + 1, param, values_list[idx], static[idx])
-        if idx == self.last_choice and self.last_choice is not None:
-          line = COLORS.OKGREEN + line
-        else:
-          _color = blue_gradient[min(round(idx / len(self.params) * len(blue_gradient)), len(blue_gradient) - 1)]
-          line = COLORS.BASE(_color) + line
-        to_print.append(line)
-
-      extras = {'l': ('Toggle live params', COLORS.WARNING),
-                'e': ('Exit opEdit', COLORS.PINK)}
-
-      to_print += ['---'] + ['{}. {}'.format(ext_col + e, ext_txt + COLORS.ENDC) for e, (ext_txt, ext_col) in extras.items()]
-      print('\n'.join(to_print))
+        self.info('Here are your live parameters:')
+        self.info('(changes take effect within a second)', end='\n')
+      print(self.render_listing())
       self.prompt('\nChoose a parameter to edit (by index or name):')
 
       choice = input('>> ').strip().lower()
-      parsed, choice = self.parse_choice(choice, len(to_print) - len(extras))
+      parsed, choice = self.parse_choice(choice, len(self.params))
       if parsed == 'continue':
         continue
       elif parsed == 'change':
@@ -97,10 +133,59 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
       elif parsed == 'live':
         self.last_choice = None
         self.live_tuning = not self.live_tuning
+        self._view = None
         self.op_params.put('op_edit_live_mode', self.live_tuning)  # for next opEdit startup
       elif parsed == 'exit':
         return
 
+  def refresh_params(self):
+    if self.op_params._watcher is None:  # no inotify, a single stat of the params directory if nothing was written
+      self.op_params.get(force_update=True)
+    if self._view is None:
+      self._view = [k for k, p in self.op_params.fork_params.items() if not p.hidden and (p.live or not self.live_tuning)]
+      self.name_index = NameIndex(self._view)
+    self.params = {k: self.op_params.params[k] for k in self._view}
+
+    version = self.op_params.version()  # taken first, so a change racing with the below is rendered again next time
+    for key in self.op_params.changed_since(self._drawn_version):
+      self._lines.pop(key, None)
+    self._drawn_version = version
+    return version
+
+  def render_listing(self):  # only lines of params that changed since the last redraw are formatted again
+    version = self.refresh_params()
+    state = (version, self.live_tuning, self.last_choice)
+    if self._listing is not None and self._listing[0] == state:
+      return self._listing[1]
+
+    to_print = []
+    blue_gradient = [33, 39, 45, 51, 87]
+    for idx, param in enumerate(self._view):
+      if param not in self._lines:
+        self._lines[param] = self.render_param(param, self.params[param])
+      line = '{}. {}'.format(idx + 1, self._lines[param])
+      if idx == self.last_choice and self.last_choice is not None:
+        line = COLORS.OKGREEN + line
+      else:
+        _color = blue_gradient[min(round(idx / len(self._view) * len(blue_gradient)), len(blue_gradient) - 1)]
+        line = COLORS.BASE(_color) + line
+      to_print.append(line)
+
+    extras = {'l': ('Toggle live params', COLORS.WARNING),
+              'e': ('Exit opEdit', COLORS.PINK)}
+
+    to_print += ['---'] + ['{}. {}'.format(ext_col + e, ext_txt + COLORS.ENDC) for e, (ext_txt, ext_col) in extras.items()]
+    self._listing = (state, '\n'.join(to_print))
+    return self._listing[1]
+
+  def render_param(self, key, v):
+    if len(str(v)) < 20:
+      v = self.color_from_type(v)
+    else:
+      v = '{} ... {}'.format(str(v)[:30], str(v)[-15:])
+    static = COLORS.INFO + '(static)' + COLORS.ENDC if self.op_params.fork_params[key].static else ''
+    return '{}: {}  {}'.format(key, v, static)
+
   def parse_choice(self, choice, opt_len):
     if choice.isdigit():
       choice = int(choice)
@@ -113,14 +198,12 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
     if choice in ['l', 'live']:  # live tuning mode
       return 'live', choice
     elif choice in ['exit', 'e', '']:
-      self.error('Exiting opEdit!', sleep_time=0)
+      self.error('Exiting opEdit!')
       return 'exit', choice
     else:  # find most similar param to user's input
-      param_sims = [(idx, self.str_sim(choice, param.lower())) for idx, param in enumerate(self.params)]
-      param_sims = [param for param in param_sims if param[1] > 0.33]
-      if len(param_sims) > 0:
-        chosen_param = sorted(param_sims, key=lambda param: param[1], reverse=True)[0]
-        return 'change', chosen_param[0]  # return idx
+      chosen_param = self.name_index.find(choice)
+      if chosen_param is not None:
+        return 'change', self._view.index(chosen_param)  # return idx
 
     self.error('Invalid choice!')
     return 'continue', choice
@@ -135,9 +218,9 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
 
       old_value = self.params[chosen_key]
       if not param_info.static:
-        self.info2('Chosen parameter: {}{} (live!)'.format(chosen_key, COLORS.BASE(207)), sleep_time=0)
+        self.info2('Chosen parameter: {}{} (live!)'.format(chosen_key, COLORS.BASE(207)))
       else:
-        self.info2('Chosen parameter: {}{} (static)'.format(chosen_key, COLORS.BASE(207)), sleep_time=0)
+        self.info2('Chosen parameter: {}{} (static)'.format(chosen_key, COLORS.BASE(207)))
 
       to_print = []
       if param_info.has_description:
@@ -145,19 +228,23 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
       if param_info.static:
         to_print.append(COLORS.WARNING + '>>  A reboot is required for changes to this parameter!' + COLORS.ENDC)
       if not param_info.static and not param_info.live:
-        to_print.append(COLORS.WARNING + '>>  Changes take effect within 10 seconds for this parameter!' + COLORS.ENDC)
+        seconds = param_info.read_frequency  # params that haven't changed in a while are read less often, except in live mode
+        to_print.append(COLORS.WARNING + '>>  Changes take effect within {:g} to {:g} seconds for this parameter ({:g} in live mode)!'.format(
+          seconds, seconds * MAX_BACKOFF, seconds) + COLORS.ENDC)
       if param_info.has_allowed_types:
-        to_print.append(COLORS.RED + '>>  Allowed types: {}'.format(', '.join([at.__name__ for at in param_info.allowed_types])) + COLORS.ENDC)
+        to_print.append(COLORS.RED + '>>  Allowed types: {}'.format(', '.join(sorted(at.__name__ for at in param_info.allowed_types)) or 'list of any') + COLORS.ENDC)
+      for constraint in param_info.describe_constraints():
+        to_print.append(COLORS.RED + '>>  Allowed {}'.format(constraint) + COLORS.ENDC)
       to_print.append(COLORS.WARNING + '>>  Default value: {}'.format(self.color_from_type(param_info.default_value)) + COLORS.ENDC)
 
       if to_print:
         print('\n{}\n'.format('\n'.join(to_print)))
 
       if param_info.is_list:
-        self.change_param_list(old_value, param_info, chosen_key)  # TODO: need to merge the code in this function with the below to reduce redundant code
+        self.change_param_list(param_info, chosen_key)  # TODO: need to merge the code in this function with the below to reduce redundant code
         return
 
-      self.info('Current value: {}{} (type: {})'.format(self.color_from_type(old_value), COLORS.INFO, type(old_value).__name__), sleep_time=0)
+      self.info('Current value: {}{} (type: {})'.format(self.color_from_type(old_value), COLORS.INFO, type(old_value).__name__))
 
       while True:
         self.prompt('\nEnter your new value (enter to exit):')
@@ -167,8 +254,9 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
           return
 
         new_value = self.str_eval(new_value)
-        if not param_info.is_valid(new_value):
-          self.error('The type of data you entered ({}) is not allowed with this parameter!'.format(type(new_value).__name__))
+        reason = param_info.check(new_value)
+        if reason is not None:
+          self.error(reason)
           continue
 
         if not param_info.static:  # stay in live tuning interface
@@ -176,7 +264,7 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
           self.success('Saved {} with value: {}{}! (type: {})'.format(chosen_key, self.color_from_type(new_value), COLORS.SUCCESS, type(new_value).__name__))
         else:  # else ask to save and break
           self.warning('\nOld value: {}{} (type: {})'.format(self.color_from_type(old_value), COLORS.WARNING, type(old_value).__name__))
-          self.success('New value: {}{} (type: {})'.format(self.color_from_type(new_value), COLORS.OKGREEN, type(new_value).__name__), sleep_time=0)
+          self.success('New value: {}{} (type: {})'.format(self.color_from_type(new_value), COLORS.OKGREEN, type(new_value).__name__))
           self.prompt('\nDo you want to save this?')
           if self.input_with_options(['Y', 'N'], 'N')[0] == 0:
             self.op_params.put(chosen_key, new_value)
@@ -185,9 +273,10 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
             self.info('Not saved!')
           return
 
-  def change_param_list(self, old_value, param_info, chosen_key):
+  def change_param_list(self, param_info, chosen_key):
+    version, old_value = self.read_list_param(chosen_key)  # we only write back if nobody else changed the list since
     while True:
-      self.info('Current value: {} (type: {})'.format(old_value, type(old_value).__name__), sleep_time=0)
+      self.info('Current value: {} (type: {})'.format(old_value, type(old_value).__name__))
       self.prompt('\nEnter index to edit (0 to {}):'.format(len(old_value) - 1))
       choice_idx = self.str_eval(input('>> '))
       if choice_idx == '':
@@ -199,8 +288,8 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
         continue
 
       while True:
-        self.info('Chosen index: {}'.format(choice_idx), sleep_time=0)
-        self.info('Value: {} (type: {})'.format(old_value[choice_idx], type(old_value[choice_idx]).__name__), sleep_time=0)
+        self.info('Chosen index: {}'.format(choice_idx))
+        self.info('Value: {} (type: {})'.format(old_value[choice_idx], type(old_value[choice_idx]).__name__))
         self.prompt('\nEnter your new value:')
         new_value = input('>> ').strip()
         if new_value == '':
@@ -208,16 +297,27 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
           break
 
         new_value = self.str_eval(new_value)
-        if not param_info.is_valid(new_value):
-          self.error('The type of data you entered ({}) is not allowed with this parameter!'.format(type(new_value).__name__))
+        new_list = old_value[:choice_idx] + [new_value] + old_value[choice_idx + 1:]
+        reason = param_info.check(new_list)  # lists are checked as a whole, for types, range, length and shape
+        if reason is not None:
+          self.error(reason)
           continue
 
-        old_value[choice_idx] = new_value
+        old_value = new_list
 
-        self.op_params.put(chosen_key, old_value)
+        if not self.op_params.compare_and_put(chosen_key, old_value, version):
+          self.error('{} was changed by another process, reloading it!'.format(chosen_key))
+          version, old_value = self.read_list_param(chosen_key)
+          break
+        version = self.op_params.key_version(chosen_key)
         self.success('Saved {} with value: {}{}! (type: {})'.format(chosen_key, self.color_from_type(new_value), COLORS.SUCCESS, type(new_value).__name__), end='\n')
         break
 
+  def read_list_param(self, key):
+    version = self.op_params.key_version(key)  # taken first, so a write racing with the read below fails the compare
+    value = self.op_params.get(key, force_update=True)
+    return version, value.tolist() if self.op_params.fork_params[key].is_array else list(value)
+
   def color_from_type(self, v):
     v_color = ''
     if type(v) in self.type_colors:
@@ -240,37 +340,21 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
     msg = self.str_color(msg, style='warning')
     print(msg, flush=True, end='\n' + end)
 
-  def info(self, msg, sleep_time=None, end=''):
-    if sleep_time is None:
-      sleep_time = self.sleep_time
+  def info(self, msg, end=''):
     msg = self.str_color(msg, style='info')
-
     print(msg, flush=True, end='\n' + end)
-    time.sleep(sleep_time)
 
-  def info2(self, msg, sleep_time=None, end=''):
-    if sleep_time is None:
-      sleep_time = self.sleep_time
+  def info2(self, msg, end=''):
     msg = self.str_color(msg, style=86)
-
     print(msg, flush=True, end='\n' + end)
-    time.sleep(sleep_time)
 
-  def error(self, msg, sleep_time=None, end='', surround=True):
-    if sleep_time is None:
-      sleep_time = self.sleep_time
+  def error(self, msg, end='', surround=True):
     msg = self.str_color(msg, style='fail', surround=surround)
-
     print(msg, flush=True, end='\n' + end)
-    time.sleep(sleep_time)
 
-  def success(self, msg, sleep_time=None, end=''):
-    if sleep_time is None:
-      sleep_time = self.sleep_time
+  def success(self, msg, end=''):
     msg = self.str_color(msg, style='success')
-
     print(msg, flush=True, end='\n' + end)
-    time.sleep(sleep_time)
 
   @staticmethod
   def str_color(msg, style, surround=False):
@@ -322,4 +406,144 @@ class opEdit:  # use by running `python /data/openpilot/op_edit.py`
     return dat
 
 
-opEdit()
+def _to_json(value):  # array params as lists
+  return value.tolist() if hasattr(value, 'tolist') else value
+
+
+def _parse_value(text):
+  try:
+    return json.loads(text)
+  except ValueError:
+    return text
+
+
+def _fail(msg):
+  print('op_edit: {}'.format(msg), file=sys.stderr)
+  return EXIT_INVALID
+
+
+def _read_params_json(path):  # Returns the dict in a json file (or stdin for -), raises ValueError if it isn't one
+  try:
+    if path == '-':
+      params = json.load(sys.stdin)
+    else:
+      with open(path) as f:
+        params = json.load(f)
+  except OSError as e:
+    raise ValueError(e)
+  if not isinstance(params, dict):
+    raise ValueError('Expected a json object of params and values')
+  return params
+
+
+def _invalid_params(op_params, params):  # Returns every reason params can't be put, so a batch is fixed in one go
+  reasons = []
+  for key, value in params.items():
+    if key not in op_params.fork_params:
+      reasons.append('{}: Unknown param'.format(key))
+      continue
+    reason = op_params.fork_params[key].check(value)  # allowed_types and constraints, same as .put()
+    if reason is not None:
+      reasons.append('{}: {}'.format(key, reason))
+  return reasons
+
+
+def _differences(op_params, params):  # Returns {key: [current value, value in params]} for the params that differ
+  current = op_params.get_many(list(params), force_update=True)
+  return {k: [_to_json(current[k]), v] for k, v in params.items() if _to_json(current[k]) != v}
+
+
+def _put_params(op_params, params, dry_run=False):
+  reasons = _invalid_params(op_params, params)
+  if reasons:
+    return _fail('Nothing was written, invalid params:\n  ' + '\n  '.join(reasons))
+  changes = _differences(op_params, params)
+  if not dry_run:
+    op_params.put_many({k: params[k] for k in changes})
+  static = [k for k in changes if op_params.fork_params[k].static]
+  if static:
+    print('op_edit: A reboot is required for changes to {}'.format(', '.join(static)), file=sys.stderr)
+  print(json.dumps(changes, indent=2))
+  return EXIT_OK
+
+
+def cmd_get(op_params, args):
+  unknown = [k for k in args.keys if k not in op_params.fork_params]
+  if unknown:
+    return _fail('Unknown params: {}'.format(', '.join(unknown)))
+  values = op_params.get_many(args.keys, force_update=True)
+  print(json.dumps(_to_json(values[args.keys[0]]) if len(args.keys) == 1 else {k: _to_json(v) for k, v in values.items()}))
+  return EXIT_OK
+
+
+def cmd_set(op_params, args):
+  params = {}
+  for assignment in args.assignments:
+    key, sep, value = assignment.partition('=')
+    if not sep:
+      return _fail('Expected key=value, got {}'.format(assignment))
+    params[key] = _parse_value(value)
+  return _put_params(op_params, params, args.dry_run)
+
+
+def cmd_dump(op_params, args):
+  keys = args.keys or [k for k, p in op_params.fork_params.items() if args.all or not p.hidden]
+  unknown = [k for k in keys if k not in op_params.fork_params]
+  if unknown:
+    return _fail('Unknown params: {}'.format(', '.join(unknown)))
+  print(json.dumps({k: _to_json(v) for k, v in op_params.get_many(keys, force_update=True).items()}, indent=2))
+  return EXIT_OK
+
+
+def cmd_load(op_params, args):
+  try:
+    params = _read_params_json(args.file)
+  except ValueError as e:
+    return _fail(e)
+  return _put_params(op_params, params, args.dry_run)
+
+
+def cmd_diff(op_params, args):
+  try:
+    params = _read_params_json(args.file)
+  except ValueError as e:
+    return _fail(e)
+  unknown = [k for k in params if k not in op_params.fork_params]
+  if unknown:
+    return _fail('Unknown params: {}'.format(', '.join(unknown)))
+  changes = _differences(op_params, params)
+  print(json.dumps(changes, indent=2))
+  return EXIT_DIFFERENT if changes else EXIT_OK
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Edit opParams, interactively when no command is given')
+  commands = parser.add_subparsers(dest='command')
+  get_parser = commands.add_parser('get', help='print the values of params as json')
+  get_parser.add_argument('keys', nargs='+')
+  get_parser.set_defaults(func=cmd_get)
+  set_parser = commands.add_parser('set', help='validate and write key=value pairs in one batch, values are json')
+  set_parser.add_argument('assignments', nargs='+', metavar='key=value')
+  set_parser.add_argument('--dry-run', action='store_true', help='only validate and print what would change')
+  set_parser.set_defaults(func=cmd_set)
+  dump_parser = commands.add_parser('dump', help='print params and their values as a json object')
+  dump_parser.add_argument('keys', nargs='*', help='params to dump (default: all)')
+  dump_parser.add_argument('--all', action='store_true', help='include hidden params')
+  dump_parser.set_defaults(func=cmd_dump)
+  load_parser = commands.add_parser('load', help='validate and write a json object of params in one batch')
+  load_parser.add_argument('file', nargs='?', default='-', help='json file, - for stdin (default)')
+  load_parser.add_argument('--dry-run', action='store_true', help='only validate and print what would change')
+  load_parser.set_defaults(func=cmd_load)
+  diff_parser = commands.add_parser('diff', help='print params whose values differ from a json object, exits with 1 if any do')
+  diff_parser.add_argument('file', nargs='?', default='-', help='json file, - for stdin (default)')
+  diff_parser.set_defaults(func=cmd_diff)
+  args = parser.parse_args(argv)
+
+  if args.command is None:
+    opEdit()
+    return EXIT_OK
+  return args.func(opParams(), args)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
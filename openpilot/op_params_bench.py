@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+  Benchmarks opParams hot paths against a temporary PARAMS_DIR and prints (or saves) JSON results.
+
+    python op_params_bench.py --sizes 10 100 1000 10000 --output bench.json
+    python op_params_bench.py --compare bench.json  # exits with 1 if any p50 regressed past --threshold
+
+  Per operation it reports p50/p99/mean latency, read and write syscalls per call (syscr + syscw from /proc/self/io,
+  Linux only, so stat, open, rename and fsync aren't counted), and from tracemalloc the peak traced bytes and the
+  memory blocks per call still allocated after the loop (what calls retain, not how many allocations they make).
+  Codecs are benchmarked on their own, encoding and decoding typical values, and report the encoded size.
+
+    python op_params_bench.py --sizes --backends --codecs json binary  # only the codec benchmark
+"""
+import gc
+import os
+import sys
+import time
+import json
+import types
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+BACKENDS = ['dir', 'packed', 'watch', 'lazy']
+CODEC_VALUES = {  # typical param values
+  'float': 0.06,
+  'bool': True,
+  'int': 5,
+  'str': 'sshane',
+  'list_10': [float(i) / 3 for i in range(10)],
+  'list_1000': [float(i) / 3 for i in range(1000)],
+}
+TIME_BUDGET_NS = 0.5e9  # per operation, the iteration count is scaled down for slow operations
+
+
+def setup_params_dir():
+  """
+    Points opParams at a temporary PARAMS_DIR so benchmarks never touch the real params.
+    Outside of openpilot, common.travis_checker doesn't exist, so a local stand-in provides BASEDIR.
+  """
+  tmp_dir = tempfile.mkdtemp(prefix='op_params_bench_')
+  basedir = os.path.join(tmp_dir, 'openpilot')
+  try:
+    import common.travis_checker  # noqa: F401 pylint: disable=unused-import
+  except ImportError:
+    travis_checker = types.ModuleType('common.travis_checker')
+    travis_checker.BASEDIR = basedir
+    sys.modules['common.travis_checker'] = travis_checker
+
+  import common.op_params as op_params_module
+  if not hasattr(op_params_module, '_REAL_PATHS'):  # remember the real paths before the first redirect
+    op_params_module._REAL_PATHS = {name: getattr(op_params_module, name) for name in dir(op_params_module)
+                                    if name == 'BASEDIR' or name.endswith(('_DIR', '_PATH', '_FILE'))}
+  real_basedir = op_params_module._REAL_PATHS['BASEDIR']
+  for name, path in op_params_module._REAL_PATHS.items():  # every path under BASEDIR is moved under tmp_dir
+    if path.startswith(real_basedir):
+      setattr(op_params_module, name, tmp_dir + path[len(real_basedir):])
+  op_params_module.SHM_PATH = os.path.join(tmp_dir, 'no_shm')  # never publish bench puts to a real shared segment
+  return tmp_dir, op_params_module
+
+
+def make_params_class(op_params_module, n_params):
+  """An opParams whose fork_params are n_params generated params: a third each live, non-live and static"""
+  Param, NUMBER = op_params_module.Param, op_params_module.NUMBER
+  fork_params = {}  # built once, like FORK_PARAMS
+  for idx in range(n_params):
+    kind = ('live', 'nonlive', 'static')[idx % 3]
+    fork_params['{}_{}'.format(kind, idx)] = Param(float(idx), NUMBER, live=kind == 'live', static=kind == 'static')
+
+  class BenchParams(op_params_module.opParams):
+    def _run_init(self):
+      self.fork_params = fork_params
+      super()._run_init()
+
+  return BenchParams
+
+
+def new_params(params_class, backend):
+  op_params = params_class(watch=backend == 'watch', packed=backend == 'packed', lazy=backend == 'lazy')
+  if op_params._watcher is not None:  # don't leave a watcher thread behind for every construction
+    op_params._watcher.stop()
+    op_params._watcher = None
+  return op_params
+
+
+def read_write_syscalls():  # read + write syscalls made by this process so far, None if unavailable
+  try:
+    with open('/proc/self/io') as f:
+      counters = dict(line.split(': ') for line in f.read().splitlines())
+    return int(counters['syscr']) + int(counters['syscw'])
+  except (OSError, KeyError, ValueError):
+    return None
+
+
+def percentile(sorted_values, pct):
+  return sorted_values[min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))]
+
+
+def measure(fn, setup=None, max_iterations=5000):
+  setup = setup or (lambda: None)
+  setup()
+  t = time.perf_counter_ns()
+  fn()  # warm up and estimate
+  iterations = int(max(5, min(max_iterations, TIME_BUDGET_NS / max(time.perf_counter_ns() - t, 1))))
+
+  latencies = []
+  for _ in range(iterations):
+    setup()
+    t = time.perf_counter_ns()
+    fn()
+    latencies.append(time.perf_counter_ns() - t)
+  latencies.sort()
+
+  overhead = read_write_syscalls()  # reading /proc/self/io counts itself, measure that with zero calls
+  overhead = None if overhead is None else read_write_syscalls() - overhead
+  syscalls = read_write_syscalls()
+  for _ in range(iterations):
+    setup()
+    fn()
+  if syscalls is not None:
+    syscalls = (read_write_syscalls() - syscalls - overhead) / iterations
+
+  gc.collect()  # so blocks freed by a collection during the loop were allocated in it
+  tracemalloc.start()  # only traces blocks allocated from here on, so frees of older ones can't make this negative
+  for _ in range(iterations):
+    setup()
+    fn()
+  snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  retained = sum(stat.count for stat in snapshot.statistics('filename')) / iterations
+
+  return {'calls': iterations, 'p50_ns': percentile(latencies, 50), 'p99_ns': percentile(latencies, 99),
+          'mean_ns': sum(latencies) / iterations, 'read_write_syscalls_per_call': syscalls,
+          'retained_blocks_per_call': retained, 'alloc_peak_bytes': peak}
+
+
+def bench_backend(op_params_module, backend, n_params):
+  params_class = make_params_class(op_params_module, n_params)
+  op_params = new_params(params_class, backend)
+  keys = {kind: next(k for k in op_params.fork_params if k.startswith(kind)) for kind in ('live', 'nonlive', 'static')}
+  live_key = keys['live']
+  handle = op_params.handle(live_key)
+
+  def make_stale(key):
+    def setup():
+      op_params._scheduler.expire(key)
+      op_params._last_generation.pop(key, None)
+    return setup
+
+  ops = {
+    'construct': (lambda: new_params(params_class, backend), None),
+    'get_live': (lambda: op_params.get(live_key), None),
+    'get_live_refresh': (lambda: op_params.get(live_key), make_stale(live_key)),
+    'get_nonlive': (lambda: op_params.get(keys['nonlive']), None),
+    'get_static': (lambda: op_params.get(keys['static']), None),
+    'get_force_update': (lambda: op_params.get(live_key, force_update=True), None),
+    'get_all_force_update': (lambda: op_params.get(force_update=True), None),  # every opEdit redraw
+    'handle_get': (handle.get, None),
+    'handle_value': (lambda: handle.value, None),
+    'put': (lambda: op_params.put(live_key, 1.5), None),
+  }
+
+  results = []
+  for op, (fn, setup) in ops.items():
+    result = {'backend': backend, 'n_params': n_params, 'op': op}
+    result.update(measure(fn, setup))
+    results.append(result)
+  if op_params._watcher is not None:
+    op_params._watcher.stop()
+  return results
+
+
+def bench_codecs(codecs):
+  import common.op_params_codec as codec_module
+  results = []
+  for name in codecs:
+    stdlib = name == 'json-stdlib'  # json without orjson, to see what it buys
+    real_orjson = codec_module._load_orjson()
+    if stdlib:
+      codec_module.orjson = None
+    try:
+      for kind, value in CODEC_VALUES.items():
+        data = codec_module.encode_value(value, 'json' if stdlib else name)
+        for op, fn in (('encode', lambda: codec_module.encode_value(value, 'json' if stdlib else name)),
+                       ('decode', lambda: codec_module.decode_value(data))):
+          result = {'backend': 'codec-' + name, 'n_params': None, 'op': '{}_{}'.format(op, kind), 'size_bytes': len(data)}
+          result.update(measure(fn))
+          results.append(result)
+    finally:
+      codec_module.orjson = real_orjson
+    print('finished {} codec'.format(name), file=sys.stderr)
+  return results
+
+
+def available_codecs():
+  shutil.rmtree(setup_params_dir()[0])  # makes common importable outside of openpilot
+  import common.op_params_codec as codec_module
+  return list(codec_module.CODECS) + (['json-stdlib'] if codec_module._load_orjson() is not None else [])
+
+
+def run(sizes, backends, codecs=()):
+  results = []
+  for n_params in sizes:
+    for backend in backends:
+      tmp_dir, op_params_module = setup_params_dir()  # fresh directory for every run
+      try:
+        results += bench_backend(op_params_module, backend, n_params)
+      finally:
+        shutil.rmtree(tmp_dir)
+      print('finished {} params, {} backend'.format(n_params, backend), file=sys.stderr)
+  results += bench_codecs(codecs)
+  return {'meta': {'python': platform.python_version(), 'platform': platform.platform(), 'time': time.time()},
+          'results': results}
+
+
+def compare(old, new, threshold):  # returns the ops whose p50 regressed by more than threshold
+  old_results = {(r['backend'], r['n_params'], r['op']): r for r in old['results']}
+  regressions = []
+  for result in new['results']:
+    old_result = old_results.get((result['backend'], result['n_params'], result['op']))
+    if old_result is not None and result['p50_ns'] > old_result['p50_ns'] * (1 + threshold):
+      regressions.append({'backend': result['backend'], 'n_params': result['n_params'], 'op': result['op'],
+                          'old_p50_ns': old_result['p50_ns'], 'new_p50_ns': result['p50_ns']})
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark opParams hot paths')
+  parser.add_argument('--sizes', type=int, nargs='*', default=[10, 100, 1000, 10000], help='param counts to benchmark')
+  parser.add_argument('--backends', nargs='*', choices=BACKENDS, default=BACKENDS)
+  parser.add_argument('--codecs', nargs='*', help='codecs to benchmark (default: all of them, none with no values)')
+  parser.add_argument('--output', help='write results to this JSON file instead of stdout')
+  parser.add_argument('--compare', help='previous results JSON file to check for regressions')
+  parser.add_argument('--threshold', type=float, default=0.2, help='allowed p50 slowdown when comparing (0.2 = 20%%)')
+  args = parser.parse_args()
+
+  codecs = available_codecs() if args.codecs is None else args.codecs
+  results = run(args.sizes, args.backends, codecs)
+  if args.compare:
+    with open(args.compare) as f:
+      results['regressions'] = compare(json.load(f), results, args.threshold)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+  else:
+    print(json.dumps(results, indent=2))
+  if results.get('regressions'):
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()